@@ -1,5 +1,6 @@
 import numpy as np
 import math
+import time
 from collections import defaultdict
 
 
@@ -54,26 +55,34 @@ def invert(N, M, Psi):
     return inv_Psi
 
 
-def expectation_maximization(N, M, Psi):
+def expectation_maximization(N, M, Psi, A_init=None, return_info=False, eps=0.001, it_max=50):
     """
     The expectation maximization method (EM) from Dong et al., 2013. It iteratively estimates the probs of objects, then
     the accuracies of sources until a convergence is reached.
     :param N: number of sources
     :param M: number of items
     :param Psi: observations
+    :param A_init: optional initial accuracies (e.g. of a previous run), nan for unknown sources
+    :param return_info: also return a dict with the number of iterations, the final delta of the
+        accuracies, whether it converged and the wall time
+    :param eps: convergence threshold on the mean absolute change of the accuracies
+    :param it_max: iterations limit
     :return:
     """
     inv_Psi = invert(N, M, Psi)
-    # convergence eps
-    eps = 0.001
-    it_max = 50
 
     # init iteration
     p = majority_voting(Psi)
     A = [np.average([p[obj][val] for obj, val in x]) for x in inv_Psi]
+    if A_init is not None:
+        # warm start, majority voting only for the unknown sources
+        A = [a if np.isnan(a_init) else a_init for a, a_init in zip(A, A_init)]
 
+    time_start = time.time()
     it = 2
+    info = {'iterations': 0, 'finalDelta': None, 'converged': False}
     while True:
+        info['iterations'] += 1
         # E-step
         p = []
         for obj in range(M):
@@ -114,14 +123,232 @@ def expectation_maximization(N, M, Psi):
         A_new = [np.average([p[obj][val] for obj, val in x]) for x in inv_Psi]
 
         # convergence check
-        if sum(abs(np.subtract(A, A_new)))/len(A) < eps:
+        delta = sum(abs(np.subtract(A, A_new)))/len(A)
+        info['finalDelta'] = float(delta)
+        if delta < eps:
             A = A_new
+            info['converged'] = True
             break
         else:
             A = A_new
 
         it += 1
         if it >= it_max:
-            return A, p
+            break
+    info['wallTime'] = time.time() - time_start
 
+    if return_info:
+        return A, p, info
     return A, p
+
+
+def psi_to_coo(Psi):
+    """
+    Flattens the observations into COO arrays, keeping the order of the votes.
+    :param Psi: observations (a list of object votes)
+    :return: item_index, worker_index, values arrays
+    """
+    item_index = np.repeat(np.arange(len(Psi)), [len(x) for x in Psi])
+    votes = [vote for x in Psi for vote in x]
+    worker_index = np.array([s for s, _ in votes], dtype=np.int64)
+    values = np.array([val for _, val in votes], dtype=np.int64)
+    return item_index, worker_index, values
+
+
+def coo_to_psi(M, item_index, worker_index, values):
+    """
+    Inverse of psi_to_coo.
+    :param M: number of items
+    :param item_index: item of each vote
+    :param worker_index: source of each vote
+    :param values: value of each vote
+    :return: Psi, observations (a list of object votes)
+    """
+    Psi = [[] for _ in range(M)]
+    for obj, s, val in zip(item_index, worker_index, values):
+        Psi[obj].append((int(s), int(val)))
+    return Psi
+
+
+def expectation_maximization_sparse(N, M, item_index, worker_index, values, A_init=None, return_info=False,
+                                    eps=0.001, it_max=50, acceleration=None):
+    """
+    Vectorized counterpart of expectation_maximization for binary votes given as COO arrays.
+    Each iteration is a few gather/scatter operations over the votes, the item
+    confidences are computed in log space. The votes of an item are processed in the
+    order they appear in the arrays, so that the clamping of the accuracies equal to 0
+    or 1 matches the one of expectation_maximization.
+    :param N: number of sources
+    :param M: number of items
+    :param item_index: item of each vote
+    :param worker_index: source of each vote
+    :param values: value of each vote, 0 or 1
+    :param A_init: optional initial accuracies (e.g. of a previous run), nan for unknown sources
+    :param return_info: also return a dict with the number of iterations, the final delta of the
+        accuracies, whether it converged and the wall time
+    :param eps: convergence threshold on the mean absolute change of the accuracies
+    :param it_max: iterations limit
+    :param acceleration: None for plain fixed point iterations, 'squarem' for SQUAREM extrapolation
+    :return: A (list of source accuracies), p (M x 2 array, p[obj][val] is the prob of val)
+    """
+    # process the votes item by item, as expectation_maximization does
+    order = np.argsort(np.asarray(item_index, dtype=np.int64), kind='mergesort')
+    item_index = np.asarray(item_index, dtype=np.int64)[order]
+    worker_index = np.asarray(worker_index, dtype=np.int64)[order]
+    values = np.asarray(values, dtype=np.int64)[order]
+    votes_num = len(values)
+
+    # items with both values (V == 2), the others are certain
+    item_votes = np.bincount(item_index, minlength=M)
+    item_pos = np.bincount(item_index, weights=values, minlength=M)
+    item_contested = (item_pos > 0) & (item_pos < item_votes)
+    # the value voted first is the first key of the item's confidences
+    item_first_value = np.zeros(M, dtype=np.int64)
+    items_voted, first_vote = np.unique(item_index, return_index=True)
+    item_first_value[items_voted] = values[first_vote]
+
+    contested = np.flatnonzero(item_contested[item_index])
+    c_item, c_worker, c_value = item_index[contested], worker_index[contested], values[contested]
+    # first vote of each source on a contested item, where a 0 accuracy gets clamped
+    worker_first_contested = np.full(N, votes_num, dtype=np.int64)
+    workers_contested, first_contested = np.unique(c_worker, return_index=True)
+    worker_first_contested[workers_contested] = contested[first_contested]
+    worker_has_contested = np.zeros(N, dtype=bool)
+    worker_has_contested[workers_contested] = True
+    c_at_first = contested == worker_first_contested[c_worker]
+    c_after_first = contested > worker_first_contested[c_worker]
+    c_first_key = c_value == item_first_value[c_item]
+
+    worker_votes = np.bincount(worker_index, minlength=N)
+
+    def m_step(p):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.bincount(worker_index, weights=p[item_index, values], minlength=N) / worker_votes
+
+    # init iteration, majority voting keeps only unanimous items
+    p = np.zeros((M, 2))
+    p[item_index, values] = (~item_contested[item_index]).astype(float)
+    A = m_step(p)
+    if A_init is not None:
+        # warm start, majority voting only for the unknown sources
+        A_init = np.asarray(A_init, dtype=float)
+        A = np.where(np.isnan(A_init), A, A_init)
+
+    def e_step(A):
+        """
+        :return: p and A as clamped by expectation_maximization during its E-step
+        """
+        A_zero = A == 0.
+        A_one = A == 1.
+        with np.errstate(divide='ignore'):
+            mismatch = np.log(1 - A[c_worker])
+        mismatch[A_one[c_worker]] = math.log(1 - 0.99)
+        c_zero = A_zero[c_worker]
+        mismatch[c_zero & (c_after_first | (c_at_first & c_first_key))] = math.log(1 - 0.01)
+        match = np.where(c_zero & c_at_first, math.log(0.01), 0.)
+        # accumulate the terms of each vote in order
+        C = np.bincount(np.column_stack([2 * c_item + c_value, 2 * c_item + 1 - c_value]).ravel(),
+                        weights=np.column_stack([match, mismatch]).ravel(), minlength=2 * M).reshape(M, 2)
+
+        # compute probs, normalize
+        with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+            p = np.exp(C)
+            p /= p.sum(axis=1)[:, np.newaxis]
+        # shift the confidences where the exponentials under/overflow
+        unstable = item_contested & ~np.isfinite(p).all(axis=1)
+        if unstable.any():
+            p[unstable] = np.exp(C[unstable] - C[unstable].max(axis=1)[:, np.newaxis])
+            p[unstable] /= p[unstable].sum(axis=1)[:, np.newaxis]
+        p[~item_contested] = 0.
+        certain = ~item_contested & (item_votes > 0)
+        p[certain, item_first_value[certain]] = 1.
+
+        # accuracies clamped during the E-step
+        A = A.copy()
+        A[A_zero & worker_has_contested] = 0.01
+        A[A_one & worker_has_contested] = 0.99
+
+        return p, A
+
+    def em_step(A):
+        p, A_clamped = e_step(A)
+        A_new = m_step(p)
+        delta = np.sum(np.abs(A_clamped - A_new)) / len(A)
+        return A_new, p, delta
+
+    def log_likelihood(A):
+        """
+        :return: log-likelihood of the votes given the accuracies, the value of each item
+            being unknown, the sources without votes are left out
+        """
+        A = np.clip(np.nan_to_num(A[worker_index]), 0.01, 0.99)
+        # log-likelihood of the votes of each item if its value is 0, if it is 1
+        C = np.bincount(np.column_stack([2 * item_index + values, 2 * item_index + 1 - values]).ravel(),
+                        weights=np.column_stack([np.log(A), np.log(1 - A)]).ravel(), minlength=2 * M).reshape(M, 2)
+        C_max = C.max(axis=1)
+        return float(np.sum(C_max + np.log(np.exp(C[:, 0] - C_max) + np.exp(C[:, 1] - C_max))))
+
+    time_start = time.time()
+    info = {'iterations': 0, 'finalDelta': None, 'converged': False}
+    if acceleration is None:
+        it = 2
+        while True:
+            A, p, delta = em_step(A)
+            info['iterations'] += 1
+            info['finalDelta'] = float(delta)
+
+            # convergence check
+            if delta < eps:
+                info['converged'] = True
+                break
+
+            it += 1
+            if it >= it_max:
+                break
+    elif acceleration == 'squarem':
+        # SQUAREM (Varadhan and Roland, 2008) on the accuracy vector, each cycle takes two
+        # EM steps and extrapolates along them, it_max bounds the number of EM steps. An
+        # extrapolation lowering the log-likelihood is dropped for the plain EM steps
+        A_fallback, delta_fallback = None, None
+        while True:
+            A_1, p, delta = em_step(A)
+            info['iterations'] += 1
+            if A_fallback is not None and not delta < delta_fallback:
+                # the extrapolation did not get closer to the fixed point, go on from the plain EM step
+                A = A_fallback
+                A_fallback = None
+                continue
+            info['finalDelta'] = float(delta)
+            if delta < eps or info['iterations'] >= it_max:
+                info['converged'] = bool(delta < eps)
+                A = A_1
+                break
+
+            A_2, p, delta = em_step(A_1)
+            info['iterations'] += 1
+            info['finalDelta'] = float(delta)
+            if delta < eps or info['iterations'] >= it_max:
+                info['converged'] = bool(delta < eps)
+                A = A_2
+                break
+
+            r = A_1 - A
+            v = A_2 - A_1 - r
+            v_norm = np.sqrt(np.nansum(v ** 2))
+            if v_norm == 0.:
+                A = A_2
+                continue
+            alpha = min(-np.sqrt(np.nansum(r ** 2)) / v_norm, -1.)
+            A_extrapolated = np.clip(A - 2 * alpha * r + alpha ** 2 * v, 0., 1.)
+            if log_likelihood(A_extrapolated) < log_likelihood(A):
+                A = A_2
+                continue
+            A = A_extrapolated
+            A_fallback, delta_fallback = A_2, delta
+    else:
+        raise ValueError('Unknown acceleration {}'.format(acceleration))
+    info['wallTime'] = time.time() - time_start
+
+    if return_info:
+        return A.tolist(), p, info
+    return A.tolist(), p
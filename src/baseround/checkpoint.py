@@ -0,0 +1,90 @@
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+
+
+class EMCheckpoint:
+    '''
+    On-disk checkpoints of the EM estimates of a job, one .npz file per (job, criterion)
+    with the accuracy of each worker and the P(out) of each item, keyed by their DB ids.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, job_id, filter_id):
+        return os.path.join(self.directory, 'em-{}-{}.npz'.format(job_id, filter_id))
+
+    def load(self, job_id, filter_id):
+        '''
+        :param job_id:
+        :param filter_id:
+        :return: dict with worker_ids, acc, item_ids, p_out arrays, None if there is no checkpoint
+        '''
+        try:
+            with np.load(self._path(job_id, filter_id)) as checkpoint:
+                return {key: checkpoint[key] for key in checkpoint.files}
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, job_id, filter_id, worker_ids, acc, item_ids, p_out):
+        '''
+        Replaces the checkpoint of the criterion atomically.
+        :param job_id:
+        :param filter_id:
+        :param worker_ids: worker ids in DB, aligned with acc
+        :param acc: accuracy of the workers
+        :param item_ids: item ids in DB, aligned with p_out
+        :param p_out: P(out) of the items
+        '''
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        path = self._path(job_id, filter_id)
+        # a file of its own for each save, the threads and processes can save the same criterion
+        fd, path_tmp = tempfile.mkstemp(dir=self.directory, prefix=os.path.basename(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as checkpoint_file:
+                np.savez(checkpoint_file,
+                         worker_ids=np.asarray(worker_ids, dtype=np.int64),
+                         acc=np.asarray(acc, dtype=float),
+                         item_ids=np.asarray(item_ids, dtype=np.int64),
+                         p_out=np.asarray(p_out, dtype=float))
+            os.replace(path_tmp, path)
+        except:
+            os.remove(path_tmp)
+            raise
+
+
+def warm_start_accuracies(checkpoint, data, worker_map, item_map):
+    '''
+    Initial accuracies of the workers of a criterion from its last checkpoint. Known workers
+    keep their accuracy, the new ones get the mean checkpointed posterior of the values they
+    voted, nan (majority voting) if they only voted on new items.
+    :param checkpoint: dict returned by EMCheckpoint.load
+    :param data: (item_index, worker_index, values) arrays
+    :param worker_map: {index_in_list: worker_id in DB}
+    :param item_map: {index_in_list: item_id in DB}
+    :return: array of initial accuracies
+    '''
+    item_index, worker_index, values = (np.asarray(i, dtype=np.int64) for i in data)
+    workers_num = len(worker_map)
+    worker_ids = [worker_map[i] for i in range(workers_num)]
+    item_ids = [item_map[i] for i in range(len(item_map))]
+
+    worker_pos = pd.Index(checkpoint['worker_ids']).get_indexer(worker_ids)
+    A_init = np.full(workers_num, np.nan)
+    A_init[worker_pos >= 0] = checkpoint['acc'][worker_pos[worker_pos >= 0]]
+
+    # posterior of the voted value, on the items in the checkpoint
+    vote_item_pos = pd.Index(checkpoint['item_ids']).get_indexer(item_ids)[item_index] \
+        if len(item_index) else np.array([], dtype=np.int64)
+    vote_known = (vote_item_pos >= 0) & np.isnan(A_init)[worker_index]
+    p_out = checkpoint['p_out'][vote_item_pos[vote_known]]
+    p_vote = np.where(values[vote_known] == 0, p_out, 1 - p_out)
+    votes_known = np.bincount(worker_index[vote_known], minlength=workers_num)
+    p_vote_sum = np.bincount(worker_index[vote_known], weights=p_vote, minlength=workers_num)
+    new_known = votes_known > 0
+    A_init[new_known] = p_vote_sum[new_known] / votes_known[new_known]
+
+    return A_init
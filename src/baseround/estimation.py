@@ -1,17 +1,94 @@
+import concurrent.futures
+import threading
 import numpy as np
 import pandas as pd
 
 from .aggregation import expectation_maximization
+from .aggregation import expectation_maximization_sparse
+from .aggregation import psi_to_coo
+from .aggregation import coo_to_psi
+from .checkpoint import EMCheckpoint
+from .checkpoint import warm_start_accuracies
+from src.metrics import EM_ITERATIONS
+from src.runs import report_progress
+
+
+# process pool running the estimations of the criteria, created on first use
+_executor = None
+_executor_workers = 0
+_executor_lock = threading.Lock()
+
+
+def get_executor(workers):
+    '''
+    :param workers: number of processes
+    :return: the process pool of this process, recreated if the number of processes changes
+    '''
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None or _executor_workers != workers:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            _executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+            _executor_workers = workers
+        return _executor
+
+
+def aggregate_votes(workers_num, items_num, data, sparse_em=False, A_init=None,
+                    eps=0.001, it_max=50, acceleration=None):
+    '''
+    Runs the EM on the votes of a criterion, it is a module level function so that
+    it can run in a process pool.
+    :param workers_num:
+    :param items_num:
+    :param data: votes, as a list of object votes or as (item_index, worker_index, values) arrays
+    :param sparse_em: use the vectorized expectation_maximization_sparse
+    :param A_init: optional initial accuracies of the workers, nan for unknown workers
+    :param eps: convergence threshold of the EM
+    :param it_max: iterations limit of the EM
+    :param acceleration: None or 'squarem', an accelerated EM always runs the vectorized one
+    :return: acc, p_out, info (dict with the number of iterations, final delta, convergence and wall time)
+    '''
+    if acceleration is not None:
+        sparse_em = True
+    if isinstance(data, tuple):
+        item_index, worker_index, values = data
+        if not sparse_em:
+            data = coo_to_psi(items_num, item_index, worker_index, values)
+    elif sparse_em:
+        item_index, worker_index, values = psi_to_coo(data)
+
+    if sparse_em:
+        acc, p_distribution, info = expectation_maximization_sparse(
+            workers_num, items_num, item_index, worker_index, values, A_init=A_init, return_info=True,
+            eps=eps, it_max=it_max, acceleration=acceleration)
+    else:
+        acc, p_distribution, info = expectation_maximization(
+            workers_num, items_num, data, A_init=A_init, return_info=True, eps=eps, it_max=it_max)
+    p_out = [i[0] for i in p_distribution]
+
+    return acc, p_out, info
 
 
 class EstimationTaskParams:
 
-    def __init__(self, db, job_id, out_threshold):
+    def __init__(self, db, job_id, out_threshold, sparse_em=False, workers=1, checkpoint_dir=None,
+                 em_tolerance=0.001, em_max_iterations=50, em_acceleration=None):
         # here 'criteria' == 'filter'
         self.db = db
         self.job_id = job_id
         self.project_id = self.db.get_project_id(self.job_id)
         self.out_threshold = out_threshold
+        # use the vectorized expectation_maximization_sparse
+        self.sparse_em = sparse_em
+        # number of processes estimating the criteria in parallel, 1 runs them in this process
+        self.workers = workers
+        # warm start the EM from the estimates of the previous call, if a directory is given
+        self.checkpoint = EMCheckpoint(checkpoint_dir) if checkpoint_dir else None
+        # convergence threshold, iterations limit and acceleration ('squarem' or None) of the EM
+        self.em_tolerance = em_tolerance
+        self.em_max_iterations = em_max_iterations
+        self.em_acceleration = em_acceleration
 
     def get_thuthfinder_input(self, filter_id):
         sql_data = '''
@@ -47,12 +124,98 @@ class EstimationTaskParams:
 
         return data_formated, worker_map, item_map
 
-    def aggregate_data(self, workers_num, items_num, data):
-        acc, p_distribution = expectation_maximization(workers_num, items_num, data)
-        p_out = [i[0] for i in p_distribution]
+    def get_thuthfinder_input_all(self, filter_list):
+        '''
+        Fetches the votes of all the criteria of the job with a single query.
+        :param filter_list: list of filter ids
+        :return: {filter_id: (data, worker_map, item_map)}, data is a tuple of
+            (item_index, worker_index, values) arrays
+        '''
+        sql_data = '''
+        select (tc ->> 'id')::bigint as criteria_id, t.item_id, t.worker_id, tc ->> 'workerAnswer' as vote
+        from task t, jsonb_array_elements(t.data -> 'criteria') tc
+        where t.job_id = {job_id};
+        '''.format(job_id=self.job_id)
+        data_df = pd.read_sql(sql_data, self.db.con)
+        data_df['vote'] = (data_df['vote'] != 'no').astype(np.int8)
+
+        truthfinder_input = {}
+        criteria_rows = data_df.groupby('criteria_id', sort=False).indices
+        for filter_id in filter_list:
+            rows = criteria_rows.get(filter_id, np.array([], dtype=np.int64))
+            # dense codes of items and workers, in the order of their ids
+            item_ids, item_index = np.unique(data_df['item_id'].values[rows], return_inverse=True)
+            worker_ids, worker_index = np.unique(data_df['worker_id'].values[rows], return_inverse=True)
+            # item_map {index_in_list: item_id in DB}, worker_map {index_in_list: worker_id in DB}
+            item_map = dict(enumerate(int(i) for i in item_ids))
+            worker_map = dict(enumerate(int(i) for i in worker_ids))
+            data = (item_index, worker_index, data_df['vote'].values[rows])
+            truthfinder_input[filter_id] = (data, worker_map, item_map)
 
+        return truthfinder_input
+
+    def aggregate_data(self, workers_num, items_num, data, eps=None, it_max=None, acceleration=None):
+        '''
+        :param workers_num:
+        :param items_num:
+        :param data: votes, as a list of object votes or as (item_index, worker_index, values) arrays
+        :param eps: convergence threshold of the EM, defaults to self.em_tolerance
+        :param it_max: iterations limit of the EM, defaults to self.em_max_iterations
+        :param acceleration: 'squarem' or None, defaults to self.em_acceleration
+        :return: acc, p_out
+        '''
+        acc, p_out, _ = aggregate_votes(workers_num, items_num, data, self.sparse_em, None,
+                                        *self._em_params(eps, it_max, acceleration))
         return acc, p_out
 
+    def _em_params(self, eps=None, it_max=None, acceleration=None):
+        return (self.em_tolerance if eps is None else eps,
+                self.em_max_iterations if it_max is None else it_max,
+                self.em_acceleration if acceleration is None else acceleration)
+
+    def aggregate_data_all(self, truthfinder_input, filter_list):
+        '''
+        Runs aggregate_data on each criterion, in parallel processes if self.workers > 1,
+        warm started from the checkpoints if self.checkpoint is set.
+        :param truthfinder_input: {filter_id: (data, worker_map, item_map)}
+        :param filter_list: list of filter ids
+        :return: list of (acc, p_out, info), in the order of filter_list
+        '''
+        em_params = self._em_params()
+        criteria_args = []
+        for filter_id in filter_list:
+            data, worker_map, item_map = truthfinder_input[filter_id]
+            A_init = None
+            if self.checkpoint is not None:
+                checkpoint = self.checkpoint.load(self.job_id, filter_id)
+                if checkpoint is not None:
+                    coo_data = data if isinstance(data, tuple) else psi_to_coo(data)
+                    A_init = warm_start_accuracies(checkpoint, coo_data, worker_map, item_map)
+            criteria_args.append((len(worker_map), len(item_map), data, self.sparse_em, A_init) + em_params)
+
+        if self.workers > 1 and len(criteria_args) > 1:
+            executor = get_executor(self.workers)
+            futures = [executor.submit(aggregate_votes, *args) for args in criteria_args]
+            for criteria_done, _ in enumerate(concurrent.futures.as_completed(futures), 1):
+                report_progress(criteria_done, len(futures), 'criteria')
+            criteria_estimates = [future.result() for future in futures]
+        else:
+            criteria_estimates = []
+            for args in criteria_args:
+                criteria_estimates.append(aggregate_votes(*args))
+                report_progress(len(criteria_estimates), len(criteria_args), 'criteria')
+
+        for filter_id, args, (acc, p_out, info) in zip(filter_list, criteria_args, criteria_estimates):
+            info['warmStart'] = args[4] is not None
+            EM_ITERATIONS.observe(info['iterations'])
+            if self.checkpoint is not None:
+                _, worker_map, item_map = truthfinder_input[filter_id]
+                self.checkpoint.save(self.job_id, filter_id,
+                                     [worker_map[i] for i in range(len(worker_map))], acc,
+                                     [item_map[i] for i in range(len(item_map))], p_out)
+
+        return criteria_estimates
+
     def estimate_filter_params(self, acc, p_out):
         filter_acc = np.mean(acc)
         filter_select = np.mean(p_out)
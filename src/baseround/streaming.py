@@ -0,0 +1,149 @@
+import math
+import threading
+import numpy as np
+
+from src.watermark import TaskWatermark
+
+
+class OnlineTruthInference:
+    '''
+    Streaming counterpart of expectation_maximization for the votes of a criterion.
+    Each answer is processed once, when it arrives: the worker is credited with the
+    posterior of the vote's value given the item's earlier votes (M-step), then the
+    item's log-odds of being OUT are updated with the current accuracy of the worker
+    (E-step). The vote is left out of its own credit, so that it does not vouch for
+    itself. The state is a few numbers per worker and per item, the votes are not kept.
+    '''
+
+    def __init__(self, prior_accuracy=0.7, prior_weight=2., prior_pout=0.5):
+        # the accuracy of a worker starts at prior_accuracy, as if prior_weight votes were seen
+        self.prior_accuracy = prior_accuracy
+        self.prior_weight = prior_weight
+        self.prior_log_odds = math.log(prior_pout / (1 - prior_pout))
+        # {worker_id: [expected correct votes, votes]}, the votes weighted by how much the
+        # earlier votes of their items tell, see observe()
+        self.worker_stats = {}
+        # {item_id: log(P(out) / P(in))}
+        self.item_log_odds = {}
+
+    def worker_accuracy(self, worker_id):
+        correct, votes = self.worker_stats.get(worker_id, (0., 0.))
+        accuracy = (correct + self.prior_weight * self.prior_accuracy) / (votes + self.prior_weight)
+        return min(max(accuracy, 0.01), 0.99)
+
+    def item_pout(self, item_id):
+        return self._pout(self.item_log_odds.get(item_id, self.prior_log_odds))
+
+    @staticmethod
+    def _pout(log_odds):
+        return 1. / (1. + math.exp(-log_odds)) if log_odds > -700 else 0.
+
+    def observe(self, worker_id, item_id, vote):
+        '''
+        :param worker_id:
+        :param item_id:
+        :param vote: 0 (OUT, 'no') or 1 (IN, 'yes')
+        '''
+        log_odds = self.item_log_odds.get(item_id, self.prior_log_odds)
+        accuracy = self.worker_accuracy(worker_id)
+
+        # M-step, with p the P(out) before the vote, the credit c = P(vote's value) has
+        # E[c] = a * u + (1 - a) * (1 - u) for a worker of accuracy a, u = p^2 + (1 - p)^2.
+        # c - (1 - u) counts as correct out of 2 * u - 1 votes, which is 0 when the earlier
+        # votes tell nothing (p = 0.5) and 1 when they are certain
+        pout = self._pout(log_odds)
+        credit = pout if vote == 0 else 1 - pout
+        agreement = pout ** 2 + (1 - pout) ** 2
+        stats = self.worker_stats.setdefault(worker_id, [0., 0.])
+        stats[0] += credit - (1 - agreement)
+        stats[1] += 2 * agreement - 1
+
+        # E-step, the vote moves the item towards its value by the worker's log-likelihood ratio
+        log_ratio = math.log(accuracy / (1 - accuracy))
+        self.item_log_odds[item_id] = log_odds + log_ratio if vote == 0 else log_odds - log_ratio
+
+    def estimates(self):
+        '''
+        :return: acc ({worker_id: accuracy}), p_out ({item_id: P(out)})
+        '''
+        acc = {worker_id: self.worker_accuracy(worker_id) for worker_id in self.worker_stats}
+        p_out = {item_id: self.item_pout(item_id) for item_id in self.item_log_odds}
+
+        return acc, p_out
+
+
+class OnlineJobEstimator:
+    '''
+    Online estimates of the criteria of a job. The answers are read from the task table
+    incrementally, only the tasks answered since the last update are fetched.
+    '''
+
+    def __init__(self, db, job_id, **inference_params):
+        self.db = db
+        self.job_id = job_id
+        self.inference_params = inference_params
+        self.lock = threading.Lock()
+        # {filter_id: OnlineTruthInference}
+        self.criteria = {}
+        # TaskWatermark of the answers processed
+        self.watermark = TaskWatermark()
+
+    def update(self):
+        '''
+        Processes the answers arrived since the last update.
+        :return: number of answers processed
+        '''
+        with self.lock:
+            answers_data, watermark = self.db.get_workers_answers(self.job_id, self.watermark)
+            for task_id, worker_id, item_id, filter_id, vote in answers_data[
+                    ['task_id', 'worker_id', 'item_id', 'criterion_id', 'vote']].itertuples(index=False):
+                if vote not in ('yes', 'no'):
+                    continue
+                self.observe(int(worker_id), int(item_id), int(filter_id), 0 if vote == 'no' else 1)
+            self.watermark = watermark
+
+        return len(answers_data)
+
+    def observe(self, worker_id, item_id, filter_id, vote):
+        if filter_id not in self.criteria:
+            self.criteria[filter_id] = OnlineTruthInference(**self.inference_params)
+        self.criteria[filter_id].observe(worker_id, item_id, vote)
+
+    def estimates(self, filter_list):
+        '''
+        :param filter_list: list of filter ids
+        :return: payload with the accuracy/selectivity of the criteria and the workers' accuracy,
+            in the format of /msr/estimate-task-parameters
+        '''
+        response_payload = {'criteria': {}, 'workersAccuracy': {}}
+        with self.lock:
+            for filter_id in filter_list:
+                if filter_id not in self.criteria:
+                    continue
+                acc, p_out = self.criteria[filter_id].estimates()
+                response_payload['criteria'][filter_id] = {
+                    'accuracy': float(np.mean(list(acc.values()))),
+                    'selectivity': float(np.mean(list(p_out.values())))
+                }
+                response_payload['workersAccuracy'][filter_id] = [{worker_id: worker_acc}
+                                                                  for worker_id, worker_acc in sorted(acc.items())]
+
+        return response_payload
+
+
+# {job_id: OnlineJobEstimator} of this process
+_estimators = {}
+_estimators_lock = threading.Lock()
+
+
+def get_online_estimator(db, job_id, **inference_params):
+    '''
+    :param db:
+    :param job_id:
+    :param inference_params: parameters of OnlineTruthInference
+    :return: the OnlineJobEstimator of the job, created on first use
+    '''
+    with _estimators_lock:
+        if job_id not in _estimators:
+            _estimators[job_id] = OnlineJobEstimator(db, job_id, **inference_params)
+        return _estimators[job_id]
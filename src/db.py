@@ -1,16 +1,72 @@
+import re
+import json
+import time
+from contextlib import contextmanager
 import sqlalchemy
 import pandas as pd
+import psycopg2.extras
+
+from src.votes import VoteTensor
+from src.watermark import TaskWatermark
+from src.shared_cache import SharedJobCache
+from src.metrics import timed_query
+from src.metrics import ROWS_READ
+from src.metrics import ROWS_WRITTEN
+
+
+# ways of computing the in/out votes of item-criterion pairs
+# 'function': compute_item_in_out_votes() is called for every pair
+# 'groupby': the votes of the whole job are aggregated in a single GROUP BY over task
+# 'table': the votes are read from the msr_item_votes table, updated incrementally from task
+VOTE_QUERIES = ('function', 'groupby', 'table')
+
+# namespaces of the (namespace, job_id) advisory locks taken by MSR-Box
+LOCK_VOTE_COUNTS = 1
+LOCK_BACKLOG = 2
+LOCK_RUNS = 3
+LOCK_LEASES = 4
 
 
 class Database:
 
-    def __init__(self, user, password, db, host, port):
+    def __init__(self, user, password, db, host, port, vote_query='function', write_batch_size=1000,
+                 pool_size=5, max_overflow=10, pool_recycle=-1, pool_pre_ping=True, lazy_reflection=True,
+                 cache_dir=None, cache_max_age=60., vote_counts_max_age=2.):
         self.user = user
         self.password = password
         self.db = db
         self.host = host
         self.port = port
-        self.con, self.meta = self._connect()
+        self.vote_query = vote_query
+        # max number of rows written by a single insert statement
+        self.write_batch_size = write_batch_size
+        # connection pool settings, see sqlalchemy.create_engine
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_recycle = pool_recycle
+        self.pool_pre_ping = pool_pre_ping
+        # reflect the schema on first access to self.meta instead of at connection time
+        self.lazy_reflection = lazy_reflection
+        self.con, self._meta = self._connect()
+        self._vote_counts_table_ready = False
+        self._task_leases_table_ready = False
+        self._runs_table_ready = False
+        # seconds the reads that can do with slightly stale vote counts skip refresh_vote_counts()
+        self.vote_counts_max_age = vote_counts_max_age
+        # {job_id: time of the last refresh_vote_counts() of this process}
+        self._vote_counts_refreshed_at = {}
+        # per-job state shared by the processes of the host, if a directory is given
+        self.cache = SharedJobCache(cache_dir, cache_max_age) if cache_dir else None
+
+    @property
+    def vote_query(self):
+        return self._vote_query
+
+    @vote_query.setter
+    def vote_query(self, vote_query):
+        if vote_query not in VOTE_QUERIES:
+            raise ValueError('vote_query must be one of {}'.format(VOTE_QUERIES))
+        self._vote_query = vote_query
 
     def _connect(self):
         '''Returns a connection and a metadata object'''
@@ -19,18 +75,109 @@ class Database:
         url = url.format(self.user, self.password, self.host, self.port, self.db)
 
         # connection object
-        con = sqlalchemy.create_engine(url, client_encoding='utf8')
+        con = sqlalchemy.create_engine(url, client_encoding='utf8',
+                                       pool_size=self.pool_size,
+                                       max_overflow=self.max_overflow,
+                                       pool_recycle=self.pool_recycle,
+                                       pool_pre_ping=self.pool_pre_ping)
 
         # bind the connection to MetaData()
-        meta = sqlalchemy.MetaData(bind=con, reflect=True)
+        meta = sqlalchemy.MetaData(bind=con)
+        self._meta_reflected = not self.lazy_reflection
+        if self._meta_reflected:
+            meta.reflect()
 
         return con, meta
 
+    @property
+    def meta(self):
+        '''Metadata object, the schema is reflected on first access'''
+        if not self._meta_reflected:
+            self._meta.reflect()
+            self._meta_reflected = True
+        return self._meta
+
+    def lock_job(self, connection, namespace, job_id):
+        '''
+        Takes the (namespace, job_id) advisory lock until the end of the transaction of connection.
+        :param connection:
+        :param namespace: one of the LOCK_* constants
+        :param job_id:
+        '''
+        connection.execute('select pg_advisory_xact_lock({}, {});'.format(namespace, job_id))
+
+    @contextmanager
+    def lock_job_runs(self, job_id):
+        '''
+        Holds the (LOCK_RUNS, job_id) session advisory lock during the block, so that the
+        runs of the job (classify, generate-tasks, ..) are executed one at a time by all
+        the processes.
+        :param job_id:
+        '''
+        connection = self.con.connect()
+        try:
+            connection.execute('select pg_advisory_lock({}, {});'.format(LOCK_RUNS, job_id))
+            try:
+                yield
+            finally:
+                connection.execute('select pg_advisory_unlock({}, {});'.format(LOCK_RUNS, job_id))
+        finally:
+            connection.close()
+
+    def try_lock_job(self, connection, namespace, job_id):
+        '''
+        Non-blocking counterpart of lock_job.
+        :param connection:
+        :param namespace: one of the LOCK_* constants
+        :param job_id:
+        :return: True if the lock was taken, False if another transaction holds it
+        '''
+        return connection.execute('select pg_try_advisory_xact_lock({}, {});'.format(namespace, job_id)).scalar()
+
+    def batches(self, rows):
+        '''
+        :param rows: list of rows to write
+        :return: generator of slices of at most write_batch_size rows
+        '''
+        for start in range(0, len(rows), self.write_batch_size):
+            yield rows[start:start + self.write_batch_size]
+
+    def execute_values(self, connection, sql_insert, rows, template=None):
+        '''
+        Inserts the rows with multi-row VALUES statements of write_batch_size rows each.
+        :param connection: sqlalchemy connection, the rows are written in its transaction
+        :param sql_insert: insert statement with a single %s placeholder for the VALUES list
+        :param rows: list of tuples
+        :param template: optional template of a single row, e.g. '(%s, %s, now())'
+        '''
+        cursor = connection.connection.cursor()
+        try:
+            psycopg2.extras.execute_values(cursor, sql_insert, rows, template=template,
+                                           page_size=self.write_batch_size)
+        finally:
+            cursor.close()
+        table = re.search(r'insert\s+into\s+(\w+)', sql_insert, re.IGNORECASE)
+        ROWS_WRITTEN.inc(len(rows), table=table.group(1) if table else 'unknown')
+
+    def invalidate_job(self, job_id):
+        '''
+        Invalidates the cached state of the job, to be called after writing its backlog or results.
+        :param job_id:
+        '''
+        if self.cache is not None:
+            self.cache.bump(job_id)
+
+    @timed_query('get_filters')
     def get_filters(self, job_id):
         '''
         :param job_id:
         :return: list of filter id
         '''
+        if self.cache is not None:
+            return self.cache.get_meta(job_id, 'filters', lambda: self._get_filters(job_id))
+        return self._get_filters(job_id)
+
+    def _get_filters(self, job_id):
 
         sql_filter_list = '''
                                 select c.* from job j 
@@ -42,6 +189,7 @@ class Database:
 
         return filter_list
 
+    @timed_query('get_items_tolabel')
     def get_items_tolabel(self, filter_id, worker_id, job_id):
         '''
         :param filter_id:
@@ -73,6 +221,7 @@ class Database:
 
         return items_tolabel
 
+    @timed_query('get_worker_votes_count')
     def get_worker_votes_count(self, job_id, worker_id):
         '''
         :param worker_id:
@@ -88,40 +237,409 @@ class Database:
         votes_count = pd.read_sql(sql_votes, self.con)['count'].values[0]
         return votes_count
 
-    def get_items_tolabel_msr(self, job_id):
+    @timed_query('get_items_tolabel_msr')
+    def get_items_tolabel_msr(self, job_id, as_tensor=False, item_ids=None):
         '''
         :param job_id:
+        :param as_tensor: return a VoteTensor instead of a DataFrame
+        :param item_ids: optional list of item ids, the other items are skipped
         :return: items_votes_data
         '''
+        if as_tensor and item_ids is None and self.cache is not None:
+            # a cheap query tells whether the cached votes are still current
+            return self.cache.get_votes(job_id, self.get_votes_fingerprint(job_id),
+                                        lambda: self._load_items_tolabel_msr(job_id))
+        return self._get_items_tolabel_msr(job_id, as_tensor, item_ids)
+
+    def _load_items_tolabel_msr(self, job_id):
+        # the fingerprint changed, e.g. with the criteria, so the cached metadata is read again too
+        self.cache.drop_meta(job_id)
+        return self._get_items_tolabel_msr(job_id, as_tensor=True)
+
+    def _get_items_tolabel_msr(self, job_id, as_tensor=False, item_ids=None):
         # query for the project_id
         project_id = self.get_project_id(job_id)
 
+        if self.vote_query == 'table':
+            self.refresh_vote_counts(job_id)
+
         # query for getting unclassified items and their votes
-        sql_items_votes = '''
-            select i.id, 
-                c.id as criteria_id, 
-                compute_item_in_out_votes({job_id}, i.id, c.id, 'yes') as in_votes,
-                compute_item_in_out_votes({job_id}, i.id, c.id, 'no') as out_votes
-            from item i join criterion c on i.project_id = c.project_id
+        sql_items_votes = self._sql_items_votes(job_id, project_id, exclude_classified=True, item_ids=item_ids)
+        items_votes_data = pd.read_sql(sql_items_votes, self.con)
+
+        if as_tensor:
+            return VoteTensor.from_frame(items_votes_data, self.get_filters(job_id))
+        return items_votes_data
+
+    def iter_items_tolabel_msr(self, job_id, chunk_items, as_tensor=False, item_ids=None):
+        '''
+        Streaming counterpart of get_items_tolabel_msr.
+        :param job_id:
+        :param chunk_items: number of items per chunk
+        :param as_tensor: yield VoteTensors instead of DataFrames
+        :param item_ids: optional list of item ids, the other items are skipped
+        :return: generator of the items_votes_data of chunk_items items at a time
+        '''
+        project_id = self.get_project_id(job_id)
+        filter_list = self.get_filters(job_id)
+
+        if self.vote_query == 'table':
+            self.refresh_vote_counts(job_id)
+
+        sql_items_votes = self._sql_items_votes(job_id, project_id, exclude_classified=True, item_ids=item_ids)
+        for items_votes_data in self._read_items_chunks(sql_items_votes, chunk_items * max(len(filter_list), 1)):
+            if as_tensor:
+                yield VoteTensor.from_frame(items_votes_data, filter_list)
+            else:
+                yield items_votes_data
+
+    def _read_items_chunks(self, sql_items_votes, chunk_rows):
+        '''
+        Reads the result of an items votes query from a server-side cursor.
+        :param sql_items_votes: query selecting id, criteria_id, in_votes, out_votes
+        :param chunk_rows: number of rows fetched at a time
+        :return: generator of DataFrames, the rows of an item are never split across them
+        '''
+        sql_ordered = 'select q.* from ({}) q order by q.id, q.criteria_id'.format(sql_items_votes.rstrip().rstrip(';'))
+        connection = self.con.connect().execution_options(stream_results=True)
+        try:
+            rows_rest = None
+            for rows in pd.read_sql(sql_ordered, connection, chunksize=chunk_rows):
+                if rows.empty:
+                    continue
+                ROWS_READ.inc(len(rows), query='items_chunks')
+                if rows_rest is not None:
+                    rows = pd.concat([rows_rest, rows], ignore_index=True)
+                # the last item may go on in the next chunk
+                last_item = rows['id'].values == rows['id'].values[-1]
+                rows_rest = rows[last_item]
+                if not last_item.all():
+                    yield rows[~last_item]
+            if rows_rest is not None:
+                yield rows_rest
+        finally:
+            connection.close()
+
+    @timed_query('get_items_unclassified')
+    def get_items_unclassified(self, job_id):
+        '''
+        :param job_id:
+        :return: ids of the items of the project without a result, in id order
+        '''
+        project_id = self.get_project_id(job_id)
+        sql_items = '''
+            select i.id
+            from item i
             where i.project_id = {project_id}
                 and i.id not in (
                     select item_id from result where job_id = {job_id}
-                );
+                )
+            order by i.id;
             '''.format(job_id=job_id, project_id=project_id)
-        items_votes_data = pd.read_sql(sql_items_votes, self.con)
+        items = pd.read_sql(sql_items, self.con)['id'].values
 
-        return items_votes_data
+        return items
 
+    @timed_query('get_backlog_capacity')
+    def get_backlog_capacity(self, job_id):
+        '''
+        :param job_id:
+        :return: DataFrame with item_id, criterion_id, step, capacity (number of votes
+            still to collect) of the backlog rows of the current step, and counted_task_id,
+            the id of the last task taken into account by the capacities
+        '''
+        if self.vote_query == 'table':
+            self.refresh_vote_counts(job_id, stale_ok=True)
+            sql_join_votes = '''
+                left join msr_item_votes v on v.job_id = b.job_id
+                    and v.item_id = b.item_id
+                    and v.criterion_id = b.criterion_id'''
+            sql_entries = 'coalesce(v.entries, 0)'
+            # msr_item_votes counts the tasks up to the watermark of its last refresh
+            sql_counted_task_id = 'coalesce((select task_id from msr_vote_watermark where job_id = {}), 0)'.format(
+                job_id)
+        else:
+            sql_join_votes = ''
+            sql_entries = 'compute_item_entries(b.job_id, b.item_id, b.criterion_id)'
+            sql_counted_task_id = 't.task_id'
+
+        sql_backlog = '''
+            with current_step as (
+                select max(step) as step from backlog where job_id = {job_id}
+            ), job_rule as (
+                select (data ->> 'votesPerTaskRule')::int as max_votes from job where id = {job_id}
+            ), job_tasks as (
+                select coalesce(max(id), 0) as task_id from task where job_id = {job_id}
+            )
+            select b.item_id,
+                b.criterion_id,
+                b.step,
+                case when b.step = 0 then j.max_votes - {sql_entries}
+                    else b.step - compute_item_entries_step(b.job_id, b.item_id, b.criterion_id, b.step)
+                end as capacity,
+                case when b.step = 0 then {sql_counted_task_id} else t.task_id end as counted_task_id
+            from backlog b
+                join current_step s on b.step = s.step
+                cross join job_rule j
+                cross join job_tasks t{sql_join_votes}
+            where b.job_id = {job_id};
+            '''.format(job_id=job_id, sql_entries=sql_entries, sql_join_votes=sql_join_votes,
+                       sql_counted_task_id=sql_counted_task_id)
+        backlog_data = pd.read_sql(sql_backlog, self.con)
+
+        return backlog_data
+
+    @timed_query('get_tasks_created')
+    def get_tasks_created(self, job_id, task_id):
+        '''
+        :param job_id:
+        :param task_id: id of the last task already read
+        :return: DataFrame with task_id, worker_id, item_id, criterion_id of the tasks created
+            after task_id, answered or not, in task order
+        '''
+        sql_tasks = '''
+            select t.id as task_id, t.worker_id, t.item_id, (tc ->> 'id')::bigint as criterion_id
+            from task t, jsonb_array_elements(t.data -> 'criteria') tc
+            where t.job_id = {job_id}
+                and t.id > {task_id}
+            order by t.id;
+            '''.format(job_id=job_id, task_id=task_id)
+        tasks_data = pd.read_sql(sql_tasks, self.con)
+
+        return tasks_data
+
+    def ensure_task_leases_table(self):
+        '''
+        Creates the table of the tasks leased to the workers by the dispensers, if missing.
+        '''
+        if self._task_leases_table_ready:
+            return
+        sql_create = '''
+            create table if not exists msr_task_leases (
+                job_id bigint not null,
+                criterion_id bigint not null,
+                item_id bigint not null,
+                worker_id bigint not null,
+                task_id bigint not null,
+                expires_at timestamp with time zone not null,
+                primary key (job_id, criterion_id, item_id, worker_id)
+            );
+            '''
+        with self.con.begin() as connection:
+            self.lock_job(connection, LOCK_LEASES, 0)
+            connection.execute(sql_create)
+        self._task_leases_table_ready = True
+
+    @timed_query('get_task_leases')
+    def get_task_leases(self, connection, job_id):
+        '''
+        Drops the leases of the job that expired or whose task was created, and returns the others.
+        :param connection: connection of the transaction holding the (LOCK_LEASES, job_id) lock
+        :param job_id:
+        :return: DataFrame with criterion_id, item_id, worker_id of the active leases
+        '''
+        sql_expire = '''
+            delete from msr_task_leases l
+            where l.job_id = {job_id}
+                and (l.expires_at <= now()
+                    or exists (
+                        select 1 from task t
+                        where t.job_id = l.job_id
+                            and t.item_id = l.item_id
+                            and t.worker_id = l.worker_id
+                            and t.id > l.task_id
+                    ));
+            '''.format(job_id=job_id)
+        connection.execute(sql_expire)
+        sql_leases = '''
+            select criterion_id, item_id, worker_id
+            from msr_task_leases
+            where job_id = {job_id};
+            '''.format(job_id=job_id)
+
+        return pd.read_sql(sql_leases, connection)
+
+    @timed_query('add_task_leases')
+    def add_task_leases(self, connection, job_id, filter_id, item_ids, worker_id, task_id, ttl):
+        '''
+        :param connection: connection of the transaction holding the (LOCK_LEASES, job_id) lock
+        :param job_id:
+        :param filter_id:
+        :param item_ids: items served to the worker
+        :param worker_id:
+        :param task_id: id of the last task of the job, the lease ends with the first task
+            of the worker on the item after it
+        :param ttl: seconds the lease lasts if the worker does not start the task
+        '''
+        sql_insert = '''
+            insert into msr_task_leases (job_id, criterion_id, item_id, worker_id, task_id, expires_at)
+            values %s
+            on conflict (job_id, criterion_id, item_id, worker_id) do update
+                set task_id = excluded.task_id, expires_at = excluded.expires_at;
+            '''
+        template = "(%s, %s, %s, %s, %s, now() + %s * interval '1 second')"
+        rows = [(job_id, filter_id, item_id, worker_id, task_id, ttl) for item_id in item_ids]
+        self.execute_values(connection, sql_insert, rows, template)
+
+    def ensure_runs_table(self):
+        '''
+        Creates the table of the background runs, if missing.
+        '''
+        if self._runs_table_ready:
+            return
+        sql_create = '''
+            create table if not exists msr_runs (
+                run_id text primary key,
+                job_id bigint not null,
+                data jsonb not null,
+                updated_at timestamp with time zone not null
+            );
+            '''
+        with self.con.begin() as connection:
+            self.lock_job(connection, LOCK_RUNS, 0)
+            connection.execute(sql_create)
+        self._runs_table_ready = True
+
+    @timed_query('save_run')
+    def save_run(self, run_dict, max_age=86400.):
+        '''
+        Saves the state of a background run, so that the status requests of all the processes see it.
+        :param run_dict: as returned by Run.to_dict
+        :param max_age: seconds the runs are kept after their last change
+        '''
+        self.ensure_runs_table()
+        sql_save = '''
+            insert into msr_runs (run_id, job_id, data, updated_at)
+            values (%s, %s, %s, now())
+            on conflict (run_id) do update
+                set data = excluded.data, updated_at = excluded.updated_at;
+            '''
+        with self.con.begin() as connection:
+            connection.execute(sql_save, run_dict['runId'], run_dict['jobId'], json.dumps(run_dict))
+            if run_dict['state'] in ('done', 'failed'):
+                connection.execute("delete from msr_runs where updated_at < now() - %s * interval '1 second';",
+                                   max_age)
+
+    @timed_query('get_run')
+    def get_run(self, run_id):
+        '''
+        :param run_id:
+        :return: the run as saved by save_run, None if unknown
+        '''
+        self.ensure_runs_table()
+        return self.con.execute('select data from msr_runs where run_id = %s;', run_id).scalar()
+
+    @timed_query('get_items_answered')
+    def get_items_answered(self, job_id, watermark=None):
+        '''
+        :param job_id:
+        :param watermark: optional TaskWatermark, only the tasks answered since are considered
+        :return: ids of the items with tasks answered since watermark, and the TaskWatermark past them
+        '''
+        watermark = watermark or TaskWatermark()
+        sql_tasks = '''
+            select t.id as task_id, t.item_id,
+                coalesce((t.data ->> 'answered')::boolean, false) as answered
+            from task t
+            where t.job_id = {job_id}
+                and {sql_watermark};
+            '''.format(job_id=job_id, sql_watermark=watermark.sql_filter())
+        tasks_data = pd.read_sql(sql_tasks, self.con)
+
+        answered = tasks_data['answered'].values.astype(bool)
+        watermark = watermark.after(tasks_data['task_id'].values, answered)
+        item_ids = pd.unique(tasks_data['item_id'].values[answered])
+
+        return [int(i) for i in item_ids], watermark
+
+    @timed_query('get_workers_answers')
+    def get_workers_answers(self, job_id, watermark=None):
+        '''
+        :param job_id:
+        :param watermark: optional TaskWatermark, only the tasks answered since are returned
+        :return: DataFrame with task_id, worker_id, item_id, criterion_id, vote of the answered tasks,
+            in task order, and the TaskWatermark past them
+        '''
+        watermark = watermark or TaskWatermark()
+        sql_answers = '''
+            select t.id as task_id, t.worker_id, t.item_id, (tc ->> 'id')::bigint as criterion_id,
+                tc ->> 'workerAnswer' as vote,
+                coalesce((t.data ->> 'answered')::boolean, false) as answered
+            from task t, jsonb_array_elements(t.data -> 'criteria') tc
+            where t.job_id = {job_id}
+                and {sql_watermark}
+            order by t.id;
+            '''.format(job_id=job_id, sql_watermark=watermark.sql_filter())
+        tasks_data = pd.read_sql(sql_answers, self.con)
+
+        answered = tasks_data['answered'].values.astype(bool)
+        watermark = watermark.after(tasks_data['task_id'].values, answered)
+        answers_data = tasks_data[answered].drop('answered', axis=1).reset_index(drop=True)
+
+        return answers_data, watermark
+
+    @timed_query('get_project_id')
     def get_project_id(self, job_id):
         '''
         :param job_id:
         :return: project_id
         '''
+        if self.cache is not None:
+            return self.cache.get_meta(job_id, 'project_id', lambda: int(self._get_project_id(job_id)))
+        return self._get_project_id(job_id)
+
+    def _get_project_id(self, job_id):
         sql_project_id = "select project_id from job where id = {job_id};".format(job_id=job_id)
         project_id = pd.read_sql(sql_project_id, self.con)['project_id'].values[0]
 
         return project_id
     
+    @timed_query('get_max_votes')
+    def get_max_votes(self, job_id):
+        '''
+        :param job_id:
+        :return: votesPerTaskRule of the job
+        '''
+        if self.cache is not None:
+            return self.cache.get_meta(job_id, 'max_votes', lambda: self._get_max_votes(job_id))
+        return self._get_max_votes(job_id)
+
+    def _get_max_votes(self, job_id):
+        sql_job = '''
+            select (data ->> 'votesPerTaskRule')::int as max_votes from job where id = {job_id}
+            '''.format(job_id=job_id)
+        rows = pd.read_sql(sql_job, self.con).to_dict(orient='records')
+        return int(rows[0]['max_votes'])
+
+    @timed_query('get_votes_fingerprint')
+    def get_votes_fingerprint(self, job_id):
+        '''
+        :param job_id:
+        :return: string that changes whenever a task of the job gets answered, a result of
+            the job is written or removed, or a criterion or an item is added to or removed
+            from the project
+        '''
+        sql_fingerprint = '''
+            with project as (
+                select project_id as id from job where id = {job_id}
+            )
+            select
+                (select count(*) from task t
+                    where t.job_id = {job_id} and (t.data ->> 'answered')::boolean = true) as answered,
+                (select coalesce(max(t.id), 0) from task t
+                    where t.job_id = {job_id} and (t.data ->> 'answered')::boolean = true) as task_id,
+                (select count(*) || '.' || coalesce(max(c.id), 0) from criterion c
+                    join project p on c.project_id = p.id) as criteria,
+                (select count(*) || '.' || coalesce(max(i.id), 0) from item i
+                    join project p on i.project_id = p.id) as items,
+                (select count(*) || '.' || coalesce(max(r.id), 0) from result r
+                    where r.job_id = {job_id}) as results;
+            '''.format(job_id=job_id)
+        answered, task_id, criteria, items, results = pd.read_sql(sql_fingerprint, self.con)[
+            ['answered', 'task_id', 'criteria', 'items', 'results']].values[0]
+        return '{}-{}-{}-{}-{}'.format(int(answered), int(task_id), criteria, items, results)
+
+    @timed_query('get_job')
     def get_job(self, job_id):
         '''
         :param job_id:
@@ -134,23 +652,248 @@ class Database:
           return rows[0]
         return None
 
+    @timed_query('get_update_filter_data')
     def get_update_filter_data(self, job_id, project_id):
         '''
         :param job_id:
         :param project_id:
         :return: item_filter_data
         '''
+        if self.vote_query == 'table':
+            self.refresh_vote_counts(job_id)
+
         # select all item-filter with at least one vote
-        sql_item_filter_data = '''
-                    select s.* from (select i.id, 
-                        c.id as criteria_id, 
-                        compute_item_in_out_votes({job_id}, i.id, c.id, 'yes') as in_votes,
-                        compute_item_in_out_votes({job_id}, i.id, c.id, 'no') as out_votes
-                    from item i join criterion c on i.project_id = c.project_id
-                    where i.project_id = {project_id}
-                    ) s
-                    where (s.in_votes > 0 or s.out_votes > 0);
-                    '''.format(job_id=job_id, project_id=project_id)
+        sql_item_filter_data = self._sql_items_votes(job_id, project_id, voted_only=True)
         item_filter_data = pd.read_sql(sql_item_filter_data, self.con)
 
         return item_filter_data
+
+    def iter_update_filter_data(self, job_id, project_id, chunk_items):
+        '''
+        Streaming counterpart of get_update_filter_data.
+        :param job_id:
+        :param project_id:
+        :param chunk_items: number of items per chunk
+        :return: generator of the item_filter_data of up to chunk_items items at a time
+        '''
+        if self.vote_query == 'table':
+            self.refresh_vote_counts(job_id)
+
+        sql_item_filter_data = self._sql_items_votes(job_id, project_id, voted_only=True)
+        chunk_rows = chunk_items * max(len(self.get_filters(job_id)), 1)
+        return self._read_items_chunks(sql_item_filter_data, chunk_rows)
+
+    def _sql_items_votes(self, job_id, project_id, exclude_classified=False, voted_only=False, vote_query=None,
+                         item_ids=None, with_entries=False):
+        '''
+        :param job_id:
+        :param project_id:
+        :param exclude_classified: skip items that already have a result
+        :param voted_only: skip item-filter pairs without votes
+        :param vote_query: one of VOTE_QUERIES, self.vote_query by default
+        :param item_ids: optional list of item ids, the other items are skipped
+        :param with_entries: also select the number of tasks of each pair, answered or not, as entries
+        :return: sql query selecting id, criteria_id, in_votes, out_votes
+        '''
+        vote_query = vote_query or self.vote_query
+        sql_exclude_classified = '''
+                and i.id not in (
+                    select item_id from result where job_id = {job_id}
+                )'''.format(job_id=job_id) if exclude_classified else ''
+        if item_ids is not None:
+            sql_exclude_classified += '''
+                and i.id in ({item_ids})'''.format(item_ids=', '.join(str(int(i)) for i in item_ids) or 'null')
+
+        if vote_query == 'function':
+            sql_items_votes = '''
+            select s.* from (select i.id, 
+                c.id as criteria_id, 
+                compute_item_in_out_votes({job_id}, i.id, c.id, 'yes') as in_votes,
+                compute_item_in_out_votes({job_id}, i.id, c.id, 'no') as out_votes{sql_entries}
+            from item i join criterion c on i.project_id = c.project_id
+            where i.project_id = {project_id}{sql_exclude_classified}
+            ) s
+            '''.format(job_id=job_id, project_id=project_id, sql_exclude_classified=sql_exclude_classified,
+                       sql_entries=''',
+                compute_item_entries({job_id}, i.id, c.id) as entries'''.format(job_id=job_id) if with_entries else '')
+            if voted_only:
+                sql_items_votes += 'where (s.in_votes > 0 or s.out_votes > 0)'
+        else:
+            if vote_query == 'groupby':
+                # votes of the whole job counted in a single pass over task
+                sql_votes = '''
+                select t.item_id,
+                    (tc ->> 'id')::bigint as criteria_id,
+                    count(*) filter (where tc ->> 'workerAnswer' = 'yes') as in_votes,
+                    count(*) filter (where tc ->> 'workerAnswer' = 'no') as out_votes,
+                    count(*) as entries
+                from task t, jsonb_array_elements(t.data -> 'criteria') tc
+                where t.job_id = {job_id}
+                group by t.item_id, (tc ->> 'id')::bigint
+                '''.format(job_id=job_id)
+            else:
+                # votes maintained by refresh_vote_counts()
+                sql_votes = '''
+                select item_id, criterion_id as criteria_id, in_votes, out_votes, entries
+                from msr_item_votes
+                where job_id = {job_id}
+                '''.format(job_id=job_id)
+            sql_items_votes = '''
+            select i.id, 
+                c.id as criteria_id, 
+                coalesce(v.in_votes, 0) as in_votes,
+                coalesce(v.out_votes, 0) as out_votes{sql_entries}
+            from item i join criterion c on i.project_id = c.project_id
+            {join} ({sql_votes}) v on v.item_id = i.id and v.criteria_id = c.id
+            where i.project_id = {project_id}{sql_exclude_classified}
+            '''.format(project_id=project_id, sql_exclude_classified=sql_exclude_classified,
+                       join='join' if voted_only else 'left join', sql_votes=sql_votes,
+                       sql_entries=''',
+                coalesce(v.entries, 0) as entries''' if with_entries else '')
+            if voted_only:
+                sql_items_votes += 'and (v.in_votes > 0 or v.out_votes > 0)'
+
+        return sql_items_votes
+
+    @timed_query('compare_vote_queries')
+    def compare_vote_queries(self, job_id):
+        '''
+        Runs every vote query on the same job, to check that they are equivalent. The 'table'
+        query is only run when it is the one in use, msr_item_votes is not maintained otherwise.
+        :param job_id:
+        :return: DataFrame of the item-filter pairs whose votes or entries differ, empty if equivalent
+        '''
+        project_id = self.get_project_id(job_id)
+        vote_queries = [vote_query for vote_query in VOTE_QUERIES
+                        if vote_query != 'table' or self.vote_query == 'table']
+        if 'table' in vote_queries:
+            self.refresh_vote_counts(job_id)
+        keys = ['id', 'criteria_id']
+        items_votes = None
+        for vote_query in vote_queries:
+            sql_items_votes = self._sql_items_votes(job_id, project_id, vote_query=vote_query, with_entries=True)
+            items_votes_data = pd.read_sql(sql_items_votes, self.con).set_index(keys)
+            items_votes_data.columns = ['{}_{}'.format(column, vote_query) for column in items_votes_data.columns]
+            if items_votes is None:
+                items_votes = items_votes_data
+            else:
+                items_votes = items_votes.join(items_votes_data, how='outer')
+
+        items_votes = items_votes.fillna(-1)
+        differ = pd.Series(False, index=items_votes.index)
+        for column in ['in_votes', 'out_votes', 'entries']:
+            values = items_votes[['{}_{}'.format(column, vote_query) for vote_query in vote_queries]]
+            differ |= values.nunique(axis=1) > 1
+
+        return items_votes[differ].reset_index()
+
+    def ensure_vote_counts_table(self):
+        '''
+        Creates the tables of the incrementally maintained item-criterion votes, if missing.
+        '''
+        if self._vote_counts_table_ready:
+            return
+        sql_create = '''
+            create table if not exists msr_item_votes (
+                job_id bigint not null,
+                item_id bigint not null,
+                criterion_id bigint not null,
+                in_votes integer not null default 0,
+                out_votes integer not null default 0,
+                entries integer not null default 0,
+                last_task_id bigint not null,
+                primary key (job_id, item_id, criterion_id)
+            );
+            alter table msr_item_votes add column if not exists entries integer not null default 0;
+            create table if not exists msr_vote_watermark (
+                job_id bigint primary key,
+                task_id bigint not null,
+                pending_task_ids bigint[] not null
+            );
+            drop table if exists msr_counted_tasks;
+            '''
+        with self.con.begin() as connection:
+            # the first process creating the tables does it alone
+            self.lock_job(connection, LOCK_VOTE_COUNTS, 0)
+            connection.execute(sql_create)
+        self._vote_counts_table_ready = True
+
+    @timed_query('refresh_vote_counts')
+    def refresh_vote_counts(self, job_id, stale_ok=False):
+        '''
+        Adds the tasks created and the votes of the tasks answered since the last refresh
+        to msr_item_votes. The position of the last refresh is the TaskWatermark of the job
+        in msr_vote_watermark: the tasks past it are counted as entries, and the votes of
+        a task are counted when it is answered, the unanswered ones being read again by
+        the next refreshes. A job without watermark, e.g. counted before the watermark
+        was kept, has its votes counted again from scratch.
+        :param job_id:
+        :param stale_ok: skip the refresh if this process refreshed the job less than
+            vote_counts_max_age seconds ago or another refresh of the job is running, for
+            the reads that can do with slightly stale counts, e.g. next-task
+        :return: number of item-criterion rows updated, None if skipped
+        '''
+        refreshed_at = time.time()
+        if stale_ok and refreshed_at - self._vote_counts_refreshed_at.get(job_id, 0) < self.vote_counts_max_age:
+            return None
+        self.ensure_vote_counts_table()
+        sql_refresh = '''
+            with tasks_new as (
+                select t.id,
+                    coalesce((t.data ->> 'answered')::boolean, false) as answered,
+                    t.id <= {task_id} as entered
+                from task t
+                where t.job_id = {job_id} and {tasks_filter}
+            ), new_votes as (
+                select t.item_id,
+                    (tc ->> 'id')::bigint as criterion_id,
+                    count(*) filter (where n.answered and tc ->> 'workerAnswer' = 'yes') as in_votes,
+                    count(*) filter (where n.answered and tc ->> 'workerAnswer' = 'no') as out_votes,
+                    count(*) filter (where not n.entered) as entries,
+                    max(t.id) as last_task_id
+                from tasks_new n
+                    join task t on t.id = n.id
+                    cross join jsonb_array_elements(t.data -> 'criteria') tc
+                group by t.item_id, (tc ->> 'id')::bigint
+            ), updated as (
+                insert into msr_item_votes (job_id, item_id, criterion_id, in_votes, out_votes, entries, last_task_id)
+                select {job_id}, item_id, criterion_id, in_votes, out_votes, entries, last_task_id from new_votes
+                on conflict (job_id, item_id, criterion_id) do update
+                    set in_votes = msr_item_votes.in_votes + excluded.in_votes,
+                        out_votes = msr_item_votes.out_votes + excluded.out_votes,
+                        entries = msr_item_votes.entries + excluded.entries,
+                        last_task_id = greatest(msr_item_votes.last_task_id, excluded.last_task_id)
+                returning 1
+            )
+            select n.id, n.answered, (select count(*) from updated) as rows_updated
+            from tasks_new n;
+            '''
+        sql_watermark = '''
+            insert into msr_vote_watermark (job_id, task_id, pending_task_ids)
+            values (%s, %s, %s)
+            on conflict (job_id) do update
+                set task_id = excluded.task_id, pending_task_ids = excluded.pending_task_ids;
+            '''
+        with self.con.begin() as connection:
+            # concurrent refreshes of the same job would count the same tasks twice
+            if not stale_ok:
+                self.lock_job(connection, LOCK_VOTE_COUNTS, job_id)
+            elif not self.try_lock_job(connection, LOCK_VOTE_COUNTS, job_id):
+                return None
+            watermark_row = connection.execute(
+                'select task_id, pending_task_ids from msr_vote_watermark where job_id = {};'.format(job_id)
+            ).first()
+            if watermark_row is None:
+                connection.execute('delete from msr_item_votes where job_id = {};'.format(job_id))
+                watermark = TaskWatermark()
+            else:
+                watermark = TaskWatermark(watermark_row.task_id, watermark_row.pending_task_ids)
+            tasks_data = pd.read_sql(sql_refresh.format(job_id=job_id, task_id=watermark.task_id,
+                                                        tasks_filter=watermark.sql_filter()), connection)
+            watermark = watermark.after(tasks_data['id'], tasks_data['answered'])
+            connection.execute(sql_watermark, job_id, watermark.task_id, sorted(watermark.pending_task_ids))
+        rows_updated = int(tasks_data['rows_updated'].iloc[0]) if len(tasks_data) else 0
+        self._vote_counts_refreshed_at[job_id] = refreshed_at
+        ROWS_WRITTEN.inc(rows_updated, table='msr_item_votes')
+
+        return rows_updated
@@ -0,0 +1,269 @@
+import threading
+import time
+import numpy as np
+
+from src.db import LOCK_LEASES
+from src.watermark import TaskWatermark
+
+
+class SeenSet:
+    '''
+    Compact set of item ids: a sorted array plus a small buffer of recent additions,
+    merged into the array once it grows.
+    '''
+
+    max_recent = 64
+
+    def __init__(self, item_ids=()):
+        self.item_ids = np.unique(np.asarray(item_ids, dtype=np.int64))
+        self.recent = set()
+
+    def add(self, item_id):
+        self.recent.add(item_id)
+        if len(self.recent) > self.max_recent:
+            self.item_ids = np.union1d(self.item_ids, np.fromiter(self.recent, dtype=np.int64))
+            self.recent = set()
+
+    def update(self, item_ids):
+        self.item_ids = np.union1d(self.item_ids, np.asarray(item_ids, dtype=np.int64))
+
+    def __contains__(self, item_id):
+        if item_id in self.recent:
+            return True
+        index = np.searchsorted(self.item_ids, item_id)
+        return index < len(self.item_ids) and self.item_ids[index] == item_id
+
+    def __len__(self):
+        return len(self.item_ids) + len(self.recent.difference(self.item_ids))
+
+
+class TaskDispenser:
+    '''
+    In-memory copy of the current backlog step of a job and of the votes each
+    (item, criterion) pair can still take. It is loaded with a single query, then
+    each next-task request only reads the tasks created since, which take the votes
+    of their pairs whether they are answered or not, so the dispensers of the job in
+    the other processes see the tasks served by this one. The leases are kept in the
+    msr_task_leases table and handed out under the (LOCK_LEASES, job_id) lock, they
+    are shared by all the processes too.
+    '''
+
+    def __init__(self, db, job_id, max_age=30., lease_ttl=0., worker_exclusion=True):
+        self.db = db
+        self.job_id = job_id
+        # seconds after which the backlog is reloaded, to pick up changes made by other processes
+        self.max_age = max_age
+        # seconds an (item, criterion) pair stays reserved for a worker after being served,
+        # until the worker starts the task, 0 disables leasing
+        self.lease_ttl = lease_ttl
+        # {filter_id: {item_id: set of the worker ids holding a lease}}, read on each request
+        self.leases = {}
+        # skip the (item, criterion) pairs the worker already voted on
+        self.worker_exclusion = worker_exclusion
+        # {worker_id: {filter_id: SeenSet of the items voted by the worker}}
+        self.seen = {}
+        # TaskWatermark of the answers included in self.seen
+        self.seen_watermark = TaskWatermark()
+        self.lock = threading.Lock()
+        self.loaded_at = None
+        # version of the job in the shared cache at the load, if any
+        self.version = None
+        # time of the last request, the idle dispensers are evicted by get_dispenser()
+        self.used_at = time.time()
+        self.step = None
+        # {filter_id: list of item ids in backlog order}
+        self.items = {}
+        # {filter_id: list of votes still to collect, aligned with self.items[filter_id]}
+        self.capacity = {}
+        # {filter_id: {item_id: index in self.items[filter_id]}}
+        self.item_index = {}
+        # {filter_id: index of the first item with votes to collect}
+        self.first_available = {}
+        # id of the last task taken into account by self.capacity
+        self.counted_task_id = 0
+
+    def load(self):
+        # read before the backlog, a write during the load is picked up by the next request
+        self.version = self.db.cache.version(self.job_id) if self.db.cache is not None else None
+        backlog_data = self.db.get_backlog_capacity(self.job_id)
+        items, capacity, item_index = {}, {}, {}
+        for filter_id, filter_data in backlog_data.groupby('criterion_id', sort=False):
+            filter_id = int(filter_id)
+            items[filter_id] = [int(i) for i in filter_data['item_id'].values]
+            capacity[filter_id] = [int(i) for i in filter_data['capacity'].fillna(0).values]
+            item_index[filter_id] = {item_id: index for index, item_id in enumerate(items[filter_id])}
+
+        self.items, self.capacity, self.item_index = items, capacity, item_index
+        self.first_available = {filter_id: 0 for filter_id in items}
+        self.step = int(backlog_data['step'].iloc[0]) if len(backlog_data) else None
+        self.counted_task_id = int(backlog_data['counted_task_id'].max()) if len(backlog_data) else 0
+        # the counts of the load can be slightly stale, see Database.refresh_vote_counts
+        self._count_tasks_created()
+        if self.worker_exclusion:
+            self._load_seen()
+        self.loaded_at = time.time()
+
+    def _load_seen(self):
+        # all the answers on the first load, then only the ones of the tasks answered since
+        answers_data, watermark = self.db.get_workers_answers(self.job_id, self.seen_watermark)
+        for (worker_id, filter_id), worker_data in answers_data.groupby(['worker_id', 'criterion_id']):
+            worker_seen = self.seen.setdefault(int(worker_id), {})
+            if int(filter_id) in worker_seen:
+                worker_seen[int(filter_id)].update(worker_data['item_id'].values)
+            else:
+                worker_seen[int(filter_id)] = SeenSet(worker_data['item_id'].values)
+        self.seen_watermark = watermark
+
+    def _count_tasks_created(self):
+        # the tasks of the step created since the load, e.g. by the answers of the served items
+        tasks_data = self.db.get_tasks_created(self.job_id, self.counted_task_id)
+        for worker_id, item_id, filter_id in tasks_data[['worker_id', 'item_id', 'criterion_id']].itertuples(
+                index=False):
+            item_id, filter_id = int(item_id), int(filter_id)
+            index = self.item_index.get(filter_id, {}).get(item_id)
+            if index is not None:
+                self.capacity[filter_id][index] -= 1
+            # the worker got the item, also if another process served it
+            if self.worker_exclusion:
+                self.seen.setdefault(int(worker_id), {}).setdefault(filter_id, SeenSet()).add(item_id)
+        if len(tasks_data):
+            self.counted_task_id = int(tasks_data['task_id'].max())
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded_at = None
+
+    def _ensure_loaded(self):
+        if self.loaded_at is None or time.time() - self.loaded_at > self.max_age:
+            self.load()
+        elif self.version is not None and self.db.cache.version(self.job_id) != self.version:
+            # the backlog was written by another process
+            self.load()
+
+    def get_tasks(self, worker_id, max_items):
+        '''
+        :param worker_id:
+        :param max_items:
+        :return: (items, [filter_id]) of a random criterion with votes to collect,
+            ([], []) if the votes left are all leased to other workers or on items the
+            worker already voted on,
+            (None, None) if no votes are left in the current step
+        '''
+        with self.lock:
+            self.used_at = time.time()
+            self._ensure_loaded()
+            if self.lease_ttl <= 0:
+                self._count_tasks_created()
+                return self._get_tasks(worker_id, max_items)
+
+            self.db.ensure_task_leases_table()
+            with self.db.con.begin() as connection:
+                # the processes hand out the leases of the job one request at a time
+                self.db.lock_job(connection, LOCK_LEASES, self.job_id)
+                self._read_leases(connection)
+                # after the leases, the tasks that ended one are counted
+                self._count_tasks_created()
+                items_tolabel, filters = self._get_tasks(worker_id, max_items)
+                if items_tolabel:
+                    self.db.add_task_leases(connection, self.job_id, filters[0], items_tolabel, worker_id,
+                                            self.counted_task_id, self.lease_ttl)
+            return items_tolabel, filters
+
+    def _get_tasks(self, worker_id, max_items):
+        # randomize the order of filters available
+        filter_list = list(self.items.keys())
+        np.random.shuffle(filter_list)
+        for filter_id in filter_list:
+            items_tolabel = self._items_available(filter_id, max_items, worker_id)
+            if items_tolabel:
+                return items_tolabel, [filter_id]
+
+        # _items_available() moved first_available past the items without votes left
+        if any(self.first_available[filter_id] < len(items) for filter_id, items in self.items.items()):
+            return [], []
+
+        return None, None
+
+    def _read_leases(self, connection):
+        leases_data = self.db.get_task_leases(connection, self.job_id)
+        leases = {}
+        for filter_id, item_id, worker_id in leases_data[['criterion_id', 'item_id', 'worker_id']].itertuples(
+                index=False):
+            leases.setdefault(int(filter_id), {}).setdefault(int(item_id), set()).add(int(worker_id))
+        self.leases = leases
+
+    def _items_available(self, filter_id, max_items, worker_id):
+        items, capacity = self.items[filter_id], self.capacity[filter_id]
+        # items before first_available have no votes left, skip them once and for all
+        start = self.first_available[filter_id]
+        while start < len(items) and capacity[start] <= 0:
+            start += 1
+        self.first_available[filter_id] = start
+
+        filter_leases = self.leases.get(filter_id, {})
+        worker_seen = self.seen.get(worker_id, {}).get(filter_id) if self.worker_exclusion else None
+        items_tolabel = []
+        for index in range(start, len(items)):
+            item_capacity = capacity[index]
+            if item_capacity > 0 and worker_seen is not None and items[index] in worker_seen:
+                continue
+            if item_capacity > 0 and filter_leases:
+                # votes reserved by other workers are not available
+                item_leases = filter_leases.get(items[index], ())
+                item_capacity -= len(item_leases) - (worker_id in item_leases)
+            if item_capacity > 0:
+                items_tolabel.append(items[index])
+                if len(items_tolabel) == max_items:
+                    break
+
+        return items_tolabel
+
+    def record_answer(self, worker_id, item_id, filter_id):
+        '''
+        Takes an answer of the worker into account without reloading the backlog. The
+        capacity and the leases are left alone, the task of the answer takes the vote of
+        the pair and ends the lease of the worker once it is created.
+        :param worker_id:
+        :param item_id:
+        :param filter_id:
+        '''
+        if not self.worker_exclusion:
+            return
+        with self.lock:
+            worker_seen = self.seen.setdefault(worker_id, {})
+            worker_seen.setdefault(filter_id, SeenSet()).add(item_id)
+
+
+# {job_id: TaskDispenser} of this process
+_dispensers = {}
+_dispensers_lock = threading.Lock()
+
+
+def get_dispenser(db, job_id, max_age=30., lease_ttl=0., worker_exclusion=True, max_idle=600.):
+    '''
+    :param db:
+    :param job_id:
+    :param max_age: seconds after which the backlog of the job is reloaded
+    :param lease_ttl: seconds the served tasks stay reserved for the worker, 0 disables leasing
+    :param worker_exclusion: skip the tasks the worker already voted on
+    :param max_idle: seconds after which the dispensers without requests are dropped, e.g. of finished jobs
+    :return: the TaskDispenser of the job, created on first use
+    '''
+    with _dispensers_lock:
+        idle_since = time.time() - max_idle
+        for idle_job_id in [i for i, dispenser in _dispensers.items() if dispenser.used_at < idle_since]:
+            del _dispensers[idle_job_id]
+        if job_id not in _dispensers:
+            _dispensers[job_id] = TaskDispenser(db, job_id, max_age, lease_ttl, worker_exclusion)
+        return _dispensers[job_id]
+
+
+def invalidate_dispenser(job_id):
+    '''
+    Forces the dispenser of the job, if any, to reload the backlog on the next request.
+    :param job_id:
+    '''
+    with _dispensers_lock:
+        dispenser = _dispensers.get(job_id)
+    if dispenser is not None:
+        dispenser.invalidate()
@@ -1,6 +1,12 @@
 import os
+import json
+import time
+import hmac
+import functools
 import pandas as pd
 from flask import Flask
+from flask import Response
+from flask import g
 from flask import request
 from flask import jsonify
 from flask import abort
@@ -11,7 +17,19 @@ from src.msr_box import FilterAssignment
 from src.msr_box import FilterParameters
 from src.msr_box import Baseround
 from src.db import Database
+from src.posterior import StoppingRuleTable
+from src.dispenser import get_dispenser
+from src.watermark import get_classification_watermark
+from src.runs import RunQueue
+from src.runs import RunError
+from src.runs import SingleFlight
 from src.baseround.estimation import EstimationTaskParams
+from src.baseround.streaming import get_online_estimator
+from src.metrics import REGISTRY
+from src.metrics import REQUEST_DURATION
+from src.profiling import profile_call
+from src.profiling import summarize
+from src.profiling import save
 
 # DB constants
 USER = os.getenv('PGUSER') or 'postgres'
@@ -19,18 +37,146 @@ PASSWORD = os.getenv('PGPASSWORD') or 'postgres'
 DB = os.getenv('PGDATABASE') or 'crowdrev'
 HOST = os.getenv('PGHOST') or 'localhost'
 PORT = os.getenv('PGPORT') or 5432
+# connection pool, see sqlalchemy.create_engine
+POOL_SIZE = int(os.getenv('MSR_DB_POOL_SIZE') or 5)
+MAX_OVERFLOW = int(os.getenv('MSR_DB_MAX_OVERFLOW') or 10)
+POOL_RECYCLE = int(os.getenv('MSR_DB_POOL_RECYCLE') or -1)
+POOL_PRE_PING = (os.getenv('MSR_DB_POOL_PRE_PING') or 'true').lower() in ('1', 'true', 'yes')
+# reflect the DB schema on first use instead of on the first request
+LAZY_REFLECTION = (os.getenv('MSR_DB_LAZY_REFLECTION') or 'true').lower() in ('1', 'true', 'yes')
+# directory of the per-job cache shared by the processes of the host (e.g. /dev/shm/msr-box), empty disables it
+SHARED_CACHE_DIR = os.getenv('MSR_SHARED_CACHE_DIR') or None
+# seconds after which the cached project, criteria and votes per task of a job are read again
+SHARED_CACHE_MAX_AGE = float(os.getenv('MSR_SHARED_CACHE_MAX_AGE') or 60)
+
+# MSR constants
+# 'function', 'groupby' or 'table', see src.db.VOTE_QUERIES
+VOTE_QUERY = os.getenv('MSR_VOTE_QUERY') or 'function'
+# seconds next-task can serve from msr_item_votes without refreshing it, with MSR_VOTE_QUERY=table
+VOTE_COUNTS_MAX_AGE = float(os.getenv('MSR_VOTE_COUNTS_MAX_AGE') or 2)
+# max number of rows written by a single insert statement
+WRITE_BATCH_SIZE = int(os.getenv('MSR_WRITE_BATCH_SIZE') or 1000)
+# estimate the task parameters with the vectorized EM
+SPARSE_EM = (os.getenv('MSR_SPARSE_EM') or 'false').lower() in ('1', 'true', 'yes')
+# number of processes estimating the criteria in parallel, 1 runs them in the request
+ESTIMATION_WORKERS = int(os.getenv('MSR_ESTIMATION_WORKERS') or 1)
+# convergence threshold and iterations limit of the EM, the request can override them
+EM_TOLERANCE = float(os.getenv('MSR_EM_TOLERANCE') or 0.001)
+EM_MAX_ITERATIONS = int(os.getenv('MSR_EM_MAX_ITERATIONS') or 50)
+# 'squarem' to accelerate the EM, empty for plain EM iterations
+EM_ACCELERATION = os.getenv('MSR_EM_ACCELERATION') or None
+# directory of the EM checkpoints used to warm start the estimations, empty disables them
+EM_CHECKPOINT_DIR = os.getenv('MSR_EM_CHECKPOINT_DIR') or None
+# number of items read at a time by classify, generate-tasks and update-filter-params, 0 reads them all at once
+STREAM_CHUNK_SIZE = int(os.getenv('MSR_STREAM_CHUNK_SIZE') or 0) or None
+# max number of memoized stopping rule evaluations shared by the jobs, 0 disables the memo
+STOPPING_RULE_TABLE_SIZE = int(os.getenv('MSR_STOPPING_RULE_TABLE_SIZE') or 100000)
+# classify only the items with votes since the previous classification of the job
+INCREMENTAL_CLASSIFY = (os.getenv('MSR_INCREMENTAL_CLASSIFY') or 'false').lower() in ('1', 'true', 'yes')
+# serve /msr/next-task from an in-memory copy of the backlog
+TASK_DISPENSER = (os.getenv('MSR_TASK_DISPENSER') or 'false').lower() in ('1', 'true', 'yes')
+# seconds after which the in-memory backlog is reloaded
+TASK_DISPENSER_MAX_AGE = float(os.getenv('MSR_TASK_DISPENSER_MAX_AGE') or 30)
+# seconds the tasks served by the dispenser stay reserved for the worker, 0 disables leasing
+TASK_LEASE_TTL = float(os.getenv('MSR_TASK_LEASE_TTL') or 0)
+# do not serve a worker the tasks it already voted on
+TASK_WORKER_EXCLUSION = (os.getenv('MSR_TASK_WORKER_EXCLUSION') or 'true').lower() in ('1', 'true', 'yes')
+# seconds after which the dispenser of a job without next-task requests is dropped
+TASK_DISPENSER_MAX_IDLE = float(os.getenv('MSR_TASK_DISPENSER_MAX_IDLE') or 600)
+
+# run classify, generate-tasks, generate-baseround and estimate-task-parameters in the background
+# unless the request sets "async": false
+ASYNC_RUNS = (os.getenv('MSR_ASYNC_RUNS') or 'false').lower() in ('1', 'true', 'yes')
+# number of threads executing the background runs
+RUN_WORKERS = int(os.getenv('MSR_RUN_WORKERS') or 2)
+# secret enabling the profiling of a request sent in the X-MSR-Profile header or in the profile
+# query parameter, empty disables profiling altogether
+PROFILE_SECRET = os.getenv('MSR_PROFILE_SECRET') or None
+# directory of the profiles, if empty the profiled request returns a summary instead of its response
+PROFILE_DIR = os.getenv('MSR_PROFILE_DIR') or None
 
 db = None
+run_queue = RunQueue(RUN_WORKERS)
+# identical concurrent requests share one execution
+single_flight = SingleFlight()
+stopping_rule_table = StoppingRuleTable(STOPPING_RULE_TABLE_SIZE) if STOPPING_RULE_TABLE_SIZE > 0 else None
 
 # connect to the database
 def setup_db():
   global db
-  db = Database(USER, PASSWORD, DB, HOST, PORT)
+  db = Database(USER, PASSWORD, DB, HOST, PORT, vote_query=VOTE_QUERY,
+                write_batch_size=WRITE_BATCH_SIZE,
+                pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW, pool_recycle=POOL_RECYCLE,
+                pool_pre_ping=POOL_PRE_PING, lazy_reflection=LAZY_REFLECTION, cache_dir=SHARED_CACHE_DIR,
+                cache_max_age=SHARED_CACHE_MAX_AGE, vote_counts_max_age=VOTE_COUNTS_MAX_AGE)
+  # the runs are saved in the database, so /msr/run-status answers in every process
+  run_queue.store = db
 
 app = Flask(__name__)
 app.before_first_request(setup_db)
 
 
+@app.before_request
+def start_timer():
+    g.request_start = time.time()
+
+
+@app.after_request
+def record_request_duration(response):
+    if 'request_start' in g:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        REQUEST_DURATION.observe(time.time() - g.request_start, route=route, method=request.method,
+                                 status=response.status_code)
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # metrics of this process, in the Prometheus text format
+    return Response(REGISTRY.exposition(), mimetype='text/plain; version=0.0.4')
+
+
+def get_job_dispenser(job_id):
+    return get_dispenser(db, job_id, TASK_DISPENSER_MAX_AGE, TASK_LEASE_TTL, TASK_WORKER_EXCLUSION,
+                         TASK_DISPENSER_MAX_IDLE)
+
+
+def dispatch_run(content, kind, job_id, func, *args):
+    '''
+    Executes func in the background if asked to, in the request otherwise. Either way
+    the runs of a job are executed one at a time, also across the processes, and a
+    request identical to one in flight gets the outcome of the latter instead of
+    executing func again.
+    :param content: body of the request, its optional "async" overrides ASYNC_RUNS
+    :param kind: name of the work
+    :param job_id:
+    :param func: function returning the response payload, raising RunError on failure
+    :param args: arguments of func
+    :return: response
+    '''
+    key = (kind, job_id, json.dumps({k: v for k, v in content.items() if k != 'async'}, sort_keys=True))
+    if content.get('async', ASYNC_RUNS):
+        run = run_queue.submit(job_id, kind, run_db_locked, job_id, func, args, key=key)
+        return jsonify(run.to_dict()), 202
+
+    try:
+        response = single_flight.do(key, run_job_locked, job_id, func, args)
+    except RunError:
+        abort(500, {"message": "error"})
+    return jsonify(response)
+
+
+def run_job_locked(job_id, func, args):
+    with run_queue.job_lock(job_id):
+        return run_db_locked(job_id, func, args)
+
+
+def run_db_locked(job_id, func, args):
+    # the runs of the job in the other processes
+    with db.lock_job_runs(job_id):
+        return func(*args)
+
+
 @app.route('/msr/generate-tasks', methods=['POST'])
 def generate_tasks():
     content = request.get_json()
@@ -38,12 +184,19 @@ def generate_tasks():
     stop_score = content['stopScore']
     out_threshold = content['outThreshold']
     filters_data = content['criteria']
-    fib = FilterAssignment(db, job_id, stop_score, out_threshold, filters_data)
-    if fib.assign_filters() == "filters_assigned":
+    fib = FilterAssignment(db, job_id, stop_score, out_threshold, filters_data, stopping_rule_table,
+                           STREAM_CHUNK_SIZE)
+    # a run that started later, e.g. in another process, may write the step first
+    step_seen = fib.current_step()
+    return dispatch_run(content, 'generate-tasks', job_id, run_generate_tasks, fib, step_seen)
+
+
+def run_generate_tasks(fib, step_seen):
+    if fib.assign_filters(step_seen) == "filters_assigned":
         response = {"message": "filters_assigned"}
-        return jsonify(response)
+        return response
     else:
-        abort(500, {"message": "error"})
+        raise RunError('error')
 
 
 @app.route('/msr/next-task', methods=['GET'])
@@ -53,7 +206,8 @@ def tab_msr():
     max_items = int(request.args.get('maxItems'))
 
     # task assignment baseline
-    tab_msr = TaskAssignmentMSR(db, job_id, worker_id, max_items)
+    dispenser = get_job_dispenser(job_id) if TASK_DISPENSER else None
+    tab_msr = TaskAssignmentMSR(db, job_id, worker_id, max_items, dispenser)
     items, filters = tab_msr.get_tasks()
 
     # check if job is finished
@@ -72,12 +226,28 @@ def tab_msr():
     return jsonify(response)
 
 
+@app.route('/msr/task-answered', methods=['POST'])
+def task_answered():
+    content = request.get_json()
+    job_id = int(content['jobId'])
+    worker_id = int(content['workerId'])
+    item_id = int(content['itemId'])
+    filters_answers = content['criteria']
+
+    if TASK_DISPENSER:
+        dispenser = get_job_dispenser(job_id)
+        for filter_answer in filters_answers:
+            dispenser.record_answer(worker_id, item_id, int(filter_answer['id']))
+
+    return jsonify({"message": "recorded"})
+
+
 @app.route('/msr/update-filter-params/<int:job_id>', methods=['PUT'])
 def update_filter_params(job_id):
     content = request.get_json()
     filters_data = content['criteria']
 
-    fp = FilterParameters(db, job_id, filters_data)
+    fp = FilterParameters(db, job_id, filters_data, STREAM_CHUNK_SIZE)
     filter_select_new = fp.update_filter_params()
 
     return jsonify(filter_select_new)
@@ -90,14 +260,21 @@ def classify():
     filters_data = content['criteria']
     out_threshold = content['outThreshold']
     in_threshold = content['inThreshold']
+    # re-evaluate all the unclassified items, e.g. to check the incremental classification
+    full_scan = bool(content.get('fullScan', False))
 
+    watermark = get_classification_watermark(job_id) if INCREMENTAL_CLASSIFY else None
     cl_msr = ClassificationMSR(
-        db, job_id, filters_data, out_threshold, in_threshold)
-    if cl_msr.classify() == "classified":
+        db, job_id, filters_data, out_threshold, in_threshold, watermark, STREAM_CHUNK_SIZE)
+    return dispatch_run(content, 'classify', job_id, run_classify, cl_msr, full_scan)
+
+
+def run_classify(cl_msr, full_scan):
+    if cl_msr.classify(full_scan) == "classified":
         response = {"message": "classified"}
-        return jsonify(response)
+        return response
     else:
-        abort(500, {"message": "error"})
+        raise RunError('error')
 
 
 @app.route('/msr/estimate-task-parameters', methods=['POST'])
@@ -105,18 +282,31 @@ def estimate_task_parameters():
     content = request.get_json()
     job_id = int(content['jobId'])
     out_threshold = content['outThreshold']
+    em_tolerance = float(content.get('emTolerance', EM_TOLERANCE))
+    em_max_iterations = int(content.get('emMaxIterations', EM_MAX_ITERATIONS))
+    em_acceleration = content.get('emAcceleration', EM_ACCELERATION)
+    if em_acceleration not in (None, 'squarem'):
+        abort(400, {"message": "Unknown emAcceleration"})
+
+    etp = EstimationTaskParams(db, job_id, out_threshold, sparse_em=SPARSE_EM, workers=ESTIMATION_WORKERS,
+                               checkpoint_dir=EM_CHECKPOINT_DIR, em_tolerance=em_tolerance,
+                               em_max_iterations=em_max_iterations, em_acceleration=em_acceleration)
+    return dispatch_run(content, 'estimate-task-parameters', job_id, run_estimate_task_parameters, etp)
+
 
-    etp = EstimationTaskParams(db, job_id, out_threshold)
+def run_estimate_task_parameters(etp):
+    job_id = etp.job_id
     p_out_statistics_raw = []  # [[p_outs for filter1], [p_outs for filter2], ..]
     response_payload = {'criteria': {}}
     workers_accuracy = {}
     filter_list = db.get_filters(job_id)
-    for filter_id in filter_list:
+    truthfinder_input = etp.get_thuthfinder_input_all(filter_list)
+    # the criteria are independent, estimate them at once
+    criteria_estimates = etp.aggregate_data_all(truthfinder_input, filter_list)
+    convergence = {}
+    for filter_id, (acc, p_out, info) in zip(filter_list, criteria_estimates):
         # get data for filter_id
-        data, workers_map, item_map = etp.get_thuthfinder_input(filter_id)
-        workers_num = len(workers_map)
-        items_num = len(item_map)
-        acc, p_out = etp.aggregate_data(workers_num, items_num, data)
+        data, workers_map, item_map = truthfinder_input[filter_id]
         p_out_statistics_raw.append(p_out)
         filter_acc, filter_select = etp.estimate_filter_params(acc, p_out)
 
@@ -133,13 +323,28 @@ def estimate_task_parameters():
             'accuracy': filter_acc,
             'selectivity': filter_select
         }
+        convergence[filter_id] = info
     response_payload['workersAccuracy'] = workers_accuracy
+    response_payload['convergence'] = convergence
 
     item_filter_pout = {}
     for item_index, item_id in item_map.items():
         item_filter_pout[item_id] = [filter_pouts[item_index]
                                      for filter_pouts in p_out_statistics_raw]
 
+    # plain JSON types, also for the result of a background run
+    return json.loads(pd.Series(response_payload).to_json())
+
+
+@app.route('/msr/online-task-parameters', methods=['GET'])
+def online_task_parameters():
+    job_id = int(request.args.get('jobId'))
+
+    # process only the answers arrived since the last call
+    estimator = get_online_estimator(db, job_id)
+    estimator.update()
+    response_payload = estimator.estimates(db.get_filters(job_id))
+
     return pd.Series(response_payload).to_json()
 
 
@@ -148,12 +353,40 @@ def generate_baseround():
     content = request.get_json()
     job_id = int(content['jobId'])
     size = content['size']
-    base = Baseround(db, job_id, size)
+    # 'first', 'random' or 'stratified', see Baseround.SELECTIONS
+    selection = content.get('selection', 'first')
+    if selection not in Baseround.SELECTIONS:
+        abort(400, {"message": "Unknown selection"})
+    base = Baseround(db, job_id, size, selection)
+    return dispatch_run(content, 'generate-baseround', job_id, run_generate_baseround, base)
+
 
+def run_generate_baseround(base):
     if base.generate_baseround() == 'generated':
-        return jsonify({"message": "generated"})
+        return {"message": "generated"}
     else:
-        abort(500, {"message": "error"})
+        raise RunError('error')
+
+
+@app.route('/msr/run-status', methods=['GET'])
+def get_run_status():
+    run = run_queue.get(request.args.get('runId'))
+
+    if run == None:
+        abort(404, {"message": "The run does not exist"})
+
+    return jsonify(run.to_dict())
+
+
+@app.route('/msr/check-vote-queries', methods=['GET'])
+def check_vote_queries():
+    job_id = int(request.args.get('jobId'))
+    mismatches = db.compare_vote_queries(job_id)
+
+    return jsonify({
+        'equivalent': bool(mismatches.empty),
+        'mismatches': json.loads(mismatches.to_json(orient='records'))
+    })
 
 
 @app.route('/msr/state', methods=['GET'])
@@ -170,3 +403,39 @@ def get_state():
         })
     else:
         abort(400, {"message": "The job does not have the shortestRun property"})
+
+
+def profiled(endpoint, view):
+    '''
+    :param endpoint: name of the view
+    :param view: view function
+    :return: view function running view under cProfile when the request carries PROFILE_SECRET
+    '''
+    @functools.wraps(view)
+    def profiled_view(*args, **kwargs):
+        secret = request.headers.get('X-MSR-Profile') or request.args.get('profile')
+        if secret is None or not hmac.compare_digest(secret.encode(), PROFILE_SECRET.encode()):
+            return view(*args, **kwargs)
+
+        response, profiler = profile_call(lambda: app.make_response(view(*args, **kwargs)))
+        if PROFILE_DIR:
+            response.headers['X-MSR-Profile-File'] = save(profiler, PROFILE_DIR, endpoint)
+            return response
+        body = response.get_data(as_text=True)
+        try:
+            body = json.loads(body)
+        except ValueError:
+            pass
+        return jsonify({
+            'profile': summarize(profiler),
+            'status': response.status_code,
+            'response': body
+        })
+    return profiled_view
+
+
+# the views are wrapped only if profiling is enabled, so that it costs nothing otherwise
+if PROFILE_SECRET:
+    for endpoint, view in list(app.view_functions.items()):
+        if endpoint != 'static':
+            app.view_functions[endpoint] = profiled(endpoint, view)
@@ -0,0 +1,167 @@
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+# default buckets of the latency histograms, in seconds
+TIME_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60.)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter:
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        # {sorted label pairs: value}
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in sorted(self.values.items())]
+
+
+class Histogram:
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=TIME_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        # {sorted label pairs: [count per bucket.., count over the last bucket, sum]}
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [0] * (len(self.buckets) + 1) + [0.]
+            counts = self.values[key]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, counts in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    samples.append((self.name + '_bucket', key + (('le', _format_value(bound)),), cumulative))
+                samples.append((self.name + '_count', key, cumulative))
+                samples.append((self.name + '_sum', key, counts[-1]))
+        return samples
+
+
+class Registry:
+    '''
+    Metrics of this process, exposed in the Prometheus text format.
+    '''
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, documentation):
+        counter = Counter(name, documentation)
+        self.metrics.append(counter)
+        return counter
+
+    def histogram(self, name, documentation, buckets=TIME_BUCKETS):
+        histogram = Histogram(name, documentation, buckets)
+        self.metrics.append(histogram)
+        return histogram
+
+    def exposition(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_DURATION = REGISTRY.histogram(
+    'msr_request_duration_seconds', 'Duration of the HTTP requests by route, method and status.')
+QUERY_DURATION = REGISTRY.histogram(
+    'msr_query_duration_seconds', 'Duration of the named DB queries.')
+ROWS_READ = REGISTRY.counter(
+    'msr_rows_read_total', 'Rows fetched by the named DB queries.')
+ROWS_WRITTEN = REGISTRY.counter(
+    'msr_rows_written_total', 'Rows written by table.')
+EM_ITERATIONS = REGISTRY.histogram(
+    'msr_em_iterations', 'Iterations of the EM per criterion.', buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+ITEMS = REGISTRY.counter(
+    'msr_items_total', 'Items processed by classify and generate-tasks, by outcome.')
+
+
+class _QueryTimer:
+
+    def __init__(self):
+        # rows fetched, counted if set
+        self.rows = None
+
+
+@contextmanager
+def time_query(name):
+    '''
+    Times the block as the query name, the block can set the rows fetched on the yielded object.
+    :param name: name of the query
+    '''
+    timer = _QueryTimer()
+    start = time.time()
+    try:
+        yield timer
+    finally:
+        QUERY_DURATION.observe(time.time() - start, query=name)
+        if timer.rows is not None:
+            ROWS_READ.inc(timer.rows, query=name)
+
+
+def _count_rows(result):
+    if isinstance(result, tuple):
+        result = result[0]
+    if hasattr(result, '__len__') and not isinstance(result, (str, dict)):
+        return len(result)
+    return None
+
+
+def timed_query(name):
+    '''
+    Decorator timing a method as the query name, the length of its result is counted as rows fetched.
+    :param name: name of the query
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with time_query(name) as timer:
+                result = func(*args, **kwargs)
+                timer.rows = _count_rows(result)
+            return result
+        return wrapper
+    return decorator
@@ -1,18 +1,31 @@
 import pandas as pd
 import numpy as np
-import operator
-from scipy.special import binom
+
+from src.posterior import filter_params_arrays
+from src.posterior import compute_pout
+from src.posterior import compute_stopping_rule
+from src.dispenser import invalidate_dispenser
+from src.db import LOCK_BACKLOG
+from src.metrics import time_query
+from src.metrics import ROWS_WRITTEN
+from src.metrics import ITEMS
+from src.runs import report_progress
 
 
 class TaskAssignmentMSR:
 
-    def __init__(self, db, job_id, worker_id, max_items):
+    def __init__(self, db, job_id, worker_id, max_items, dispenser=None):
         self.db = db
         self.job_id = job_id
         self.worker_id = worker_id
         self.max_items = max_items
+        # optional in-memory TaskDispenser of the job
+        self.dispenser = dispenser
 
     def get_tasks(self):
+        if self.dispenser is not None:
+            return self.dispenser.get_tasks(self.worker_id, self.max_items)
+
         sql_filter_list = '''
             select distinct(b.criterion_id) 
             from backlog b 
@@ -24,24 +37,38 @@ class TaskAssignmentMSR:
         rows = pd.read_sql("select max(step) as step from backlog where job_id = {job_id};".format(job_id=self.job_id), self.db.con).to_dict(orient='records')
         current_step = int(rows[0]['step'])
 
+        if current_step == 0 and self.db.vote_query == 'table':
+            # the counts are refreshed by classify and generate-tasks, the workers polling
+            # the job refresh them at most every vote_counts_max_age seconds
+            self.db.refresh_vote_counts(self.job_id, stale_ok=True)
+
         # randomize the order of filters available
         np.random.shuffle(filter_list)
         filter_list = [int(i) for i in filter_list]
         for filter_id in filter_list:
             if current_step == 0:
-              sql_job = '''
-                select (data ->> 'votesPerTaskRule')::int as max_votes from job where id = {job_id}
-              '''.format(job_id=self.job_id)
-              rows = pd.read_sql(sql_job, self.db.con).to_dict(orient='records')
-              max_votes = rows[0]['max_votes']
-              sql_items_tolabel = '''
-                  select b.item_id 
-                  from backlog b 
-                  where b.job_id = {job_id}
-                  and b.criterion_id = {filter_id}
-                  and b.step = {current_step}
-                  and compute_item_entries(b.job_id, b.item_id, b.criterion_id) < {max_votes}
-              '''.format(job_id=self.job_id, filter_id=filter_id, current_step=current_step, max_votes=max_votes) 
+              max_votes = self.db.get_max_votes(self.job_id)
+              if self.db.vote_query == 'table':
+                sql_items_tolabel = '''
+                    select b.item_id 
+                    from backlog b 
+                    left join msr_item_votes v on v.job_id = b.job_id
+                        and v.item_id = b.item_id
+                        and v.criterion_id = b.criterion_id
+                    where b.job_id = {job_id}
+                    and b.criterion_id = {filter_id}
+                    and b.step = {current_step}
+                    and coalesce(v.entries, 0) < {max_votes}
+                '''.format(job_id=self.job_id, filter_id=filter_id, current_step=current_step, max_votes=max_votes)
+              else:
+                sql_items_tolabel = '''
+                    select b.item_id 
+                    from backlog b 
+                    where b.job_id = {job_id}
+                    and b.criterion_id = {filter_id}
+                    and b.step = {current_step}
+                    and compute_item_entries(b.job_id, b.item_id, b.criterion_id) < {max_votes}
+                '''.format(job_id=self.job_id, filter_id=filter_id, current_step=current_step, max_votes=max_votes) 
             else:
               sql_items_tolabel = '''
                   select b.item_id 
@@ -52,7 +79,9 @@ class TaskAssignmentMSR:
                   and compute_item_entries_step(b.job_id, b.item_id, b.criterion_id, {current_step}) < {current_step}
               '''.format(job_id=self.job_id, filter_id=filter_id,current_step=current_step)
 
-            items_tolabel = pd.read_sql(sql_items_tolabel, self.db.con)['item_id'].values
+            with time_query('next_task_items') as timer:
+                items_tolabel = pd.read_sql(sql_items_tolabel, self.db.con)['item_id'].values
+                timer.rows = len(items_tolabel)
             items_tolabel = [int(i) for i in items_tolabel]
             items_tolabel_num = len(items_tolabel)
 
@@ -68,7 +97,7 @@ class TaskAssignmentMSR:
 
 class ClassificationMSR:
 
-    def __init__(self, db, job_id, filters_data, out_threshold, in_threshold):
+    def __init__(self, db, job_id, filters_data, out_threshold, in_threshold, watermark=None, chunk_size=None):
         # here 'criteria' == 'filter'
         self.db = db
         self.job_id = job_id
@@ -77,234 +106,321 @@ class ClassificationMSR:
         self.filter_list = self.db.get_filters(self.job_id)
         self.out_threshold = out_threshold
         self.in_threshold = in_threshold
+        # optional ClassificationWatermark of the job, to classify only the items with new votes
+        self.watermark = watermark
+        # if set, stream the items this many at a time instead of loading them all
+        self.chunk_size = chunk_size
+
+    def classify(self, full_scan=False):
+        '''
+        :param full_scan: with a watermark, classify all the unclassified items anyway
+        :return: 'classified' or 'error'
+        '''
+        if self.watermark is None:
+            return self._classify()
+
+        params = (sorted((str(filter_id), filter_params['accuracy'], filter_params['selectivity'])
+                         for filter_id, filter_params in self.filters_params_dict.items()),
+                  self.out_threshold, self.in_threshold)
+        with self.watermark.lock:
+            if full_scan or self.watermark.tasks is None or self.watermark.params != params:
+                # the outcomes of the previous classification do not hold anymore
+                _, tasks = self.db.get_items_answered(self.job_id)
+                item_ids = None
+            else:
+                item_ids, tasks = self.db.get_items_answered(self.job_id, self.watermark.tasks)
 
-    def classify(self):
-        items_classified = {}
-        items_votes_data = self.db.get_items_tolabel_msr(self.job_id)
-        items_ids = items_votes_data['id'].unique()
-        for item_id in items_ids:
-            item_data = {
-                'criteria': []
-            }
-            prob_item_pos = 1.
-            for filter_id in self.filter_list:
-                # get filter-item statistics
-                filter_acc = self.filters_params_dict[str(filter_id)]['accuracy']
-                filter_select = self.filters_params_dict[str(filter_id)]['selectivity']
-                pos_c, neg_c = items_votes_data.loc[(items_votes_data['id'] == item_id) &
-                                                    (items_votes_data['criteria_id'] == filter_id)][
-                                                    ['in_votes', 'out_votes']].values[0]
-
-                # compute prob of not applying the filter filter_id on item item_id
-                term_neg = binom(pos_c + neg_c, neg_c) * filter_acc ** (neg_c) \
-                           * (1 - filter_acc) ** pos_c * filter_select
-                term_pos = binom(pos_c + neg_c, pos_c) * filter_acc ** pos_c \
-                           * (1 - filter_acc) ** (neg_c) * (1 - filter_select)
-                prob_item_filter_pos = term_pos / (term_neg + term_pos)
-                prob_item_pos *= prob_item_filter_pos
-
-                # add payload to item_data dict
-                item_filter_data = {
-                    'id': filter_id,
-                    'pout': 1 - prob_item_filter_pos,
-                    'in': pos_c,
-                    'out': neg_c
-                }
-                item_data['criteria'].append(item_filter_data)
-
-            prob_item_neg = 1 - prob_item_pos
-            if prob_item_neg > self.out_threshold:
-                # mark the item as classified
-                item_data['outcome'] = 'OUT'
-                items_classified[item_id] = item_data
-            elif prob_item_pos > self.in_threshold:
-                # mark the item as classified
-                item_data['outcome'] = 'IN'
-                items_classified[item_id] = item_data
-
-        if self.insert_items_filters(items_classified):
+            result = self._classify(item_ids)
+            if result == 'classified':
+                self.watermark.tasks = tasks
+                self.watermark.params = params
+            else:
+                self.watermark.reset()
+        return result
+
+    def _classify(self, item_ids=None):
+        if item_ids is not None and len(item_ids) == 0:
+            # no new votes
+            return 'classified'
+
+        if self.chunk_size:
+            chunks = self.db.iter_items_tolabel_msr(self.job_id, self.chunk_size, as_tensor=True, item_ids=item_ids)
+            inserted = self.insert_items_filters_chunks(self._classify_items(items_votes) for items_votes in chunks)
+        else:
+            items_votes = self.db.get_items_tolabel_msr(self.job_id, as_tensor=True, item_ids=item_ids)
+            inserted = self.insert_items_filters(self._classify_items(items_votes))
+
+        if inserted:
             return 'classified'
         else:
             return 'error'
 
+    def _classify_items(self, items_votes):
+        '''
+        :param items_votes: VoteTensor
+        :return: {item_id: item_data} of the items classified as IN or OUT
+        '''
+        items_classified = {}
+
+        # compute prob of applying each filter on each item in one batch
+        filters_acc, filters_select = filter_params_arrays(self.filters_params_dict, items_votes.filter_ids)
+        items_filters_pout = compute_pout(items_votes.in_votes, items_votes.out_votes,
+                                          filters_acc, filters_select)
+        items_prob_pos = np.prod(1 - items_filters_pout, axis=1)
+        items_prob_neg = 1 - items_prob_pos
+
+        items_out = items_prob_neg > self.out_threshold
+        items_in = ~items_out & (items_prob_pos > self.in_threshold)
+        for item_index in np.flatnonzero(items_out | items_in):
+            item_data = self._compute_item_data(items_votes, items_filters_pout, item_index)
+            # mark the item as classified
+            item_data['outcome'] = 'OUT' if items_out[item_index] else 'IN'
+            items_classified[items_votes.item_ids[item_index]] = item_data
+        ITEMS.inc(int(items_out.sum()), outcome='OUT')
+        ITEMS.inc(int(items_in.sum()), outcome='IN')
+
+        return items_classified
+
+    def _compute_item_data(self, items_votes, items_filters_pout, item_index):
+        item_data = {
+            'criteria': [{
+                'id': filter_id,
+                'pout': float(prob_item_filter_neg),
+                'in': int(pos_c),
+                'out': int(neg_c)
+            } for filter_id, prob_item_filter_neg, (pos_c, neg_c) in zip(
+                items_votes.filter_ids, items_filters_pout[item_index], items_votes.votes[item_index])]
+        }
+
+        return item_data
+
     def insert_items_filters(self, items):
+        return self.insert_items_filters_chunks([items])
+
+    def insert_items_filters_chunks(self, items_chunks):
+        '''
+        Writes the results chunk by chunk, in a single transaction.
+        :param items_chunks: iterable of {item_id: item_data}
+        :return: True if all the chunks were written
+        '''
         connection = self.db.con.connect()
         trans = connection.begin()
         try:
-            for item_id in items.keys():
-                data_json = pd.Series(items[item_id]).to_json()
-                sql_insert_data_row = '''
-                insert into result (job_id, item_id, created_at, data)
-                values({job_id}, {item_id}, now(), '{data_json}')
-                '''.format(job_id=self.job_id, item_id=item_id, data_json=data_json)
-                connection.execute(sql_insert_data_row)
+            cursor = connection.connection.cursor()
+            for chunks_done, items in enumerate(items_chunks, 1):
+                self._write_items_filters(cursor, items)
+                report_progress(chunks_done)
+            cursor.close()
             trans.commit()
         except:
             trans.rollback()
             return False
+        finally:
+            connection.close()
+        self.db.invalidate_job(self.job_id)
         return True
 
+    def _write_items_filters(self, cursor, items):
+        sql_insert_data = '''
+        insert into result (job_id, item_id, created_at, data)
+        select %s, item.key::bigint, now(), item.value
+        from json_each(%s::json) item
+        '''
+        for item_ids_batch in self.db.batches(list(items.keys())):
+            # serialize the payloads of the whole batch at once, {item_id: data}
+            data_json = pd.Series({item_id: items[item_id] for item_id in item_ids_batch}).to_json()
+            cursor.execute(sql_insert_data, (self.job_id, data_json))
+            ROWS_WRITTEN.inc(len(item_ids_batch), table='result')
+
 
 class FilterAssignment(ClassificationMSR):
 
-    def __init__(self, db, job_id, stop_score, out_threshold, filters_data):
+    def __init__(self, db, job_id, stop_score, out_threshold, filters_data, stopping_rule_table=None,
+                 chunk_size=None):
         # here 'criteria' == 'filter'
         self.db = db
         self.job_id = job_id
+        # optional StoppingRuleTable memoizing the stopping rule across calls
+        self.stopping_rule_table = stopping_rule_table
+        # if set, stream the items this many at a time instead of loading them all
+        self.chunk_size = chunk_size
         self.stop_score = stop_score
         self.out_threshold = out_threshold
         self.filters_params_dict = filters_data
         self.filter_list = self.db.get_filters(self.job_id)
 
-    def assign_filters(self):
-        items_votes_data = self.db.get_items_tolabel_msr(self.job_id)
-        items_tolabel_ids = items_votes_data['id'].unique()
+    def current_step(self):
+        '''
+        :return: last step of the backlog of the job, -1 without backlog
+        '''
+        sql_step = "select max(step) as step from backlog where job_id = {job_id};".format(job_id=self.job_id)
+        step = pd.read_sql(sql_step, self.db.con)['step'].values[0]
+        return -1 if step is None else int(step)
+
+    def assign_filters(self, step_seen=None):
+        '''
+        :param step_seen: optional current_step() when the tasks were requested, if the
+            backlog moved past it another run generated the tasks in the meantime
+        :return: 'filters_assigned' or 'Error'
+        '''
+        if step_seen is not None and self.current_step() != step_seen:
+            return "filters_assigned"
 
-        filters_assigned = []
-        items_new = []
-        items_stopped = {}
-        for item_id in items_tolabel_ids:
-            item_data = {
-                'criteria': []
-                }
-            classify_score = {}
-            n_min = {}
-
-            # initialize joint probability of getting N min OUT votes
-            joint_prob_votes_neg = {}
-            for filter_id in self.filter_list:
-                joint_prob_votes_neg[filter_id] = 1.
-                filter_acc = self.filters_params_dict[str(filter_id)]['accuracy']
-                filter_select = self.filters_params_dict[str(filter_id)]['selectivity']
-                prob_item_neg = filter_select
-
-                pos_c, neg_c = items_votes_data.loc[(items_votes_data['id'] == item_id) &
-                                                    (items_votes_data['criteria_id'] == filter_id)][
-                                                    ['in_votes', 'out_votes']].values[0]
-
-                # add payload to item_data dict
-                item_data['criteria'].append(self.__compute_item_filter_data(pos_c,
-                                             neg_c, filter_acc, filter_select, filter_id))
-
-                # estimate N min votes needed to exclude the item by a filter filter_id
-                for n in range(1, 11):
-                    # new value is negative
-                    prob_vote_neg = filter_acc * prob_item_neg + (1 - filter_acc) * (1 - prob_item_neg)
-                    joint_prob_votes_neg[filter_id] *= prob_vote_neg
-                    term_neg = binom(pos_c + neg_c + n, neg_c + n) * filter_acc ** (neg_c + n) \
-                               * (1 - filter_acc) ** pos_c * filter_select
-                    term_pos = binom(pos_c + neg_c + n, pos_c) * filter_acc ** pos_c \
-                               * (1 - filter_acc) ** (neg_c + n) * (1 - filter_select)
-                    prob_item_neg = term_neg / (term_neg + term_pos)
-
-                    if prob_item_neg >= self.out_threshold:
-                        classify_score[filter_id] = joint_prob_votes_neg[filter_id] / n
-                        n_min[filter_id] = n
-                        break
-                    elif n == 10:
-                        classify_score[filter_id] = joint_prob_votes_neg[filter_id] / n
-                        n_min[filter_id] = n
-
-            # find most promising filter to exclude the item
-            filter_ = max(classify_score.items(), key=operator.itemgetter(1))[0]
-            n_min_val = n_min[filter_]
-            joint_prob = joint_prob_votes_neg[filter_]
-
-            # check if it is needed to do stop collect votes on the item (to mark it as IN-item)
-            if n_min_val / joint_prob < self.stop_score:
-                filters_assigned.append(filter_)
-                items_new.append(item_id)
-            else:
-                # mark the item as classified
-                item_data['outcome'] = 'STOPPED'
-                items_stopped[item_id] = item_data
+        if self.chunk_size:
+            chunks = self.db.iter_items_tolabel_msr(self.job_id, self.chunk_size, as_tensor=True)
+            if self.insert_assignments_chunks(self._assign_items(items_votes) for items_votes in chunks):
+                return "filters_assigned"
+            return 'Error'
 
+        items_votes = self.db.get_items_tolabel_msr(self.job_id, as_tensor=True)
+        filters_assigned, items_new, items_stopped = self._assign_items(items_votes)
         if self.insert_items_filters_backlog(filters_assigned, items_new) and \
                 super().insert_items_filters(items_stopped):
             return "filters_assigned"
         return 'Error'
 
-    def __compute_item_filter_data(self, pos_c, neg_c, filter_acc, filter_select, filter_id):
-        term_neg = binom(pos_c + neg_c, neg_c) * filter_acc ** (neg_c) \
-                   * (1 - filter_acc) ** pos_c * filter_select
-        term_pos = binom(pos_c + neg_c, pos_c) * filter_acc ** pos_c \
-                   * (1 - filter_acc) ** (neg_c) * (1 - filter_select)
-        prob_item_filter_neg = term_neg / (term_neg + term_pos)
-
-        item_filter_data = {
-                    'id': filter_id,
-                    'pout': prob_item_filter_neg,
-                    'in': pos_c,
-                    'out': neg_c
-                }
-
-        return item_filter_data
-
-    def insert_items_filters_backlog(self, filters, items):
+    def _assign_items(self, items_votes):
+        '''
+        :param items_votes: VoteTensor
+        :return: filters and items of the new backlog rows, {item_id: item_data} of the stopped items
+        '''
+        filters_acc, filters_select = filter_params_arrays(self.filters_params_dict, items_votes.filter_ids)
+        items_filters_pout = compute_pout(items_votes.in_votes, items_votes.out_votes,
+                                          filters_acc, filters_select)
+
+        # estimate N min votes needed to exclude each item by each filter and
+        # the joint probability of getting N min OUT votes
+        stopping_rule = compute_stopping_rule if self.stopping_rule_table is None else self.stopping_rule_table.lookup
+        n_min, joint_prob_votes_neg, classify_score = stopping_rule(
+            items_votes.in_votes, items_votes.out_votes, filters_acc, filters_select, self.out_threshold)
+
+        # find most promising filter to exclude each item
+        items_index = np.arange(len(items_votes))
+        filters_index = np.argmax(classify_score, axis=1)
+        n_min_val = n_min[items_index, filters_index]
+        joint_prob = joint_prob_votes_neg[items_index, filters_index]
+
+        # check if it is needed to do stop collect votes on the item (to mark it as IN-item)
+        with np.errstate(divide='ignore'):
+            items_continue = n_min_val / joint_prob < self.stop_score
+        filters_assigned = [items_votes.filter_ids[i] for i in filters_index[items_continue]]
+        items_new = [items_votes.item_ids[i] for i in items_index[items_continue]]
+        items_stopped = {}
+        for item_index in items_index[~items_continue]:
+            item_data = self._compute_item_data(items_votes, items_filters_pout, item_index)
+            # mark the item as classified
+            item_data['outcome'] = 'STOPPED'
+            items_stopped[items_votes.item_ids[item_index]] = item_data
+        ITEMS.inc(len(items_stopped), outcome='STOPPED')
+        ITEMS.inc(len(items_new), outcome='ASSIGNED')
+
+        return filters_assigned, items_new, items_stopped
+
+    def _next_step(self, connection):
+        # concurrent writers of the job would read the same step, the lock is held until the rows are committed
+        self.db.lock_job(connection, LOCK_BACKLOG, self.job_id)
         sql_step_old = "select max(step) from backlog where job_id = {job_id};".format(job_id=self.job_id)
-        step_old = pd.read_sql(sql_step_old, self.db.con)['max'].values[0]
+        step_old = pd.read_sql(sql_step_old, connection)['max'].values[0]
         if step_old == None:
-            step = 0
-        else:
-            step = step_old + 1
+            return 0
+        return step_old + 1
 
+    def _write_items_filters_backlog(self, connection, step, filters, items):
         # create a list of tuples for inserting to the DB
         # [(job_id, item_id, criterion_id, step),..]
-        data_to_insert = zip([self.job_id]*len(items), items, filters, [step]*len(items))
+        data_to_insert = [(self.job_id, int(item_id), int(filter_id), int(step))
+                          for item_id, filter_id in zip(items, filters)]
+        self.db.execute_values(connection, '''
+            insert into backlog (job_id, item_id, criterion_id, step)
+            values %s
+            ''', data_to_insert)
+
+    def insert_assignments_chunks(self, assignments_chunks):
+        '''
+        Writes the backlog rows and the stopped items chunk by chunk, in a single transaction.
+        :param assignments_chunks: iterable of (filters, items, items_stopped) as returned by _assign_items
+        :return: True if all the chunks were written
+        '''
+        connection = self.db.con.connect()
+        trans = connection.begin()
+        try:
+            step = self._next_step(connection)
+            cursor = connection.connection.cursor()
+            for chunks_done, (filters, items, items_stopped) in enumerate(assignments_chunks, 1):
+                self._write_items_filters_backlog(connection, step, filters, items)
+                self._write_items_filters(cursor, items_stopped)
+                report_progress(chunks_done)
+            cursor.close()
+            trans.commit()
+        except:
+            trans.rollback()
+            return False
+        finally:
+            connection.close()
+        # the current step changed
+        invalidate_dispenser(self.job_id)
+        self.db.invalidate_job(self.job_id)
+        return True
+
+    def insert_items_filters_backlog(self, filters, items):
         connection = self.db.con.connect()
         trans = connection.begin()
         try:
-            for data_row in data_to_insert:
-                sql_insert_data_row = '''
-                insert into backlog (job_id, item_id, criterion_id, step)
-                values {}
-                '''.format(data_row)
-                connection.execute(sql_insert_data_row)
+            step = self._next_step(connection)
+            self._write_items_filters_backlog(connection, step, filters, items)
             trans.commit()
         except:
             trans.rollback()
             return False
+        finally:
+            connection.close()
+        # the current step changed
+        invalidate_dispenser(self.job_id)
+        self.db.invalidate_job(self.job_id)
         return True
 
 
 class FilterParameters:
 
-    def __init__(self, db, job_id, filters_data):
+    def __init__(self, db, job_id, filters_data, chunk_size=None):
         # here 'criteria' == 'filter'
         self.db = db
         self.job_id = job_id
         self.project_id = self.db.get_project_id(self.job_id)
         self.filters_params_dict = filters_data
         self.filter_list = self.db.get_filters(self.job_id)
+        # if set, stream the items this many at a time
+        self.chunk_size = chunk_size
 
     def update_filter_params(self):
-        apply_filters_prob = {}
-        for filter_id in self.filter_list:
-            apply_filters_prob[filter_id] = []
-
-        # select all item-filter with at least one vote
-        item_filter_data = self.db.get_update_filter_data(self.job_id, self.project_id)
-        for _, data in item_filter_data.iterrows():
-            filter_id = data['criteria_id']
-            filter_acc = self.filters_params_dict[str(filter_id)]['accuracy']
-            filter_select = self.filters_params_dict[str(filter_id)]['selectivity']
-
-            # compute prob of applying the filter filter_id on item item_id
-            pos_c, neg_c = data['in_votes'], data['out_votes']
-            term_neg = binom(pos_c + neg_c, neg_c) * filter_acc ** (neg_c) \
-                       * (1 - filter_acc) ** pos_c * filter_select
-            term_pos = binom(pos_c + neg_c, pos_c) * filter_acc ** pos_c \
-                       * (1 - filter_acc) ** (neg_c) * (1 - filter_select)
-            prob_item_neg = term_neg / (term_neg + term_pos)
-            # add prob_item_neg to the list of probs related to filter_id
-            apply_filters_prob[filter_id].append(prob_item_neg)
+        filters_acc, filters_select = filter_params_arrays(self.filters_params_dict, self.filter_list)
+        if self.chunk_size:
+            chunks = self.db.iter_update_filter_data(self.job_id, self.project_id, self.chunk_size)
+        else:
+            # select all item-filter with at least one vote
+            chunks = [self.db.get_update_filter_data(self.job_id, self.project_id)]
+
+        # compute prob of applying the filters on the items in one batch per chunk
+        pout_sum = np.zeros(len(self.filter_list))
+        pairs_num = np.zeros(len(self.filter_list))
+        for item_filter_data in chunks:
+            filter_index = pd.Index(self.filter_list).get_indexer(item_filter_data['criteria_id'])
+            known = filter_index >= 0
+            pout = compute_pout(item_filter_data['in_votes'].values[known],
+                                item_filter_data['out_votes'].values[known],
+                                filters_acc, filters_select, filter_index[known])
+            pout_sum += np.bincount(filter_index[known], weights=pout, minlength=len(self.filter_list))
+            pairs_num += np.bincount(filter_index[known], minlength=len(self.filter_list))
+        # mean per filter
+        with np.errstate(invalid='ignore', divide='ignore'):
+            apply_filters_prob = pout_sum / pairs_num
 
         # update selectivity of filters
         filter_params_new = {'criteria': {}}
-        for filter_id in self.filter_list:
-            if apply_filters_prob[filter_id]:
+        for filter_id, filter_select in zip(self.filter_list, apply_filters_prob):
+            if not np.isnan(filter_select):
                 filter_params_new['criteria'][filter_id] = {
-                    'selectivity': np.mean(apply_filters_prob[filter_id]),
+                    'selectivity': float(filter_select),
                     'accuracy': self.filters_params_dict[str(filter_id)]['accuracy']
                 }
             else:
@@ -317,27 +433,48 @@ class FilterParameters:
 
 class Baseround(FilterAssignment):
 
-    def __init__(self, db, job_id, size):
+    # how the items of each criterion are picked among the unclassified ones
+    SELECTIONS = ('first', 'random', 'stratified')
+
+    def __init__(self, db, job_id, size, selection='first'):
+        if selection not in self.SELECTIONS:
+            raise ValueError('Unknown selection {}'.format(selection))
         self.db = db
         self.job_id = job_id
         self.size = size
+        self.selection = selection
 
     def generate_baseround(self):
         filter_list = self.db.get_filters(self.job_id)
+        # the candidates are the same for every filter, fetch them once
+        items_tolabel = self.db.get_items_unclassified(self.job_id)
+        items_tolabel_num = len(items_tolabel)
+
+        if items_tolabel_num == 0 or items_tolabel_num < self.size:
+            return 'error'
 
         # data to insert in backlog table
         items_query = []
         filters_query = []
         for filter_id in filter_list:
-            items_tolabel = self.db.get_items_tolabel_msr(self.job_id)['id'].unique()
-            items_tolabel_num = len(items_tolabel)
-
-            if items_tolabel_num == 0 or items_tolabel_num < self.size:
-                return 'error'
-            items_query += list(items_tolabel[:self.size])
+            items_query += list(self._select_items(items_tolabel))
             filters_query += [filter_id]*self.size
 
         if self.insert_items_filters_backlog(filters_query, items_query):
             return 'generated'
         else:
             return 'error'
+
+    def _select_items(self, items):
+        '''
+        :param items: ids of the candidate items, in id order
+        :return: self.size item ids
+        '''
+        if self.selection == 'random':
+            return np.random.choice(items, self.size, replace=False)
+        if self.selection == 'stratified':
+            # one random item from each of self.size equal ranges of ids
+            bounds = np.linspace(0, len(items), self.size + 1).astype(np.int64)
+            offsets = np.floor(np.random.random_sample(self.size) * np.diff(bounds)).astype(np.int64)
+            return items[bounds[:-1] + offsets]
+        return items[:self.size]
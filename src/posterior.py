@@ -0,0 +1,168 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+from scipy.special import expit, xlogy, xlog1py
+
+
+def filter_params_arrays(filters_params_dict, filter_list):
+    '''
+    :param filters_params_dict: {'<filter_id>': {'accuracy': .., 'selectivity': ..}, ..}
+    :param filter_list: list of filter ids, it defines the order of the output vectors
+    :return: accuracy and selectivity vectors aligned with filter_list
+    '''
+    filters_acc = np.array([filters_params_dict[str(filter_id)]['accuracy']
+                            for filter_id in filter_list], dtype=float)
+    filters_select = np.array([filters_params_dict[str(filter_id)]['selectivity']
+                               for filter_id in filter_list], dtype=float)
+
+    return filters_acc, filters_select
+
+
+def compute_pout(in_votes, out_votes, filters_acc, filters_select, filter_index=None):
+    '''
+    Batched posterior probability that a filter applies to an item (the item is OUT).
+    The terms are computed in log space, so large vote counts do not overflow. The
+    binomial coefficients of the IN and OUT terms are equal and cancel out.
+
+    :param in_votes: array of IN votes
+    :param out_votes: array of OUT votes
+    :param filters_acc: accuracy, per filter vector or broadcastable array
+    :param filters_select: selectivity, per filter vector or broadcastable array
+    :param filter_index: optional array of positions in filters_acc/filters_select,
+        one per vote count. If omitted, the parameters are broadcast against the votes,
+        e.g. a (items x filters) vote matrix against per filter vectors.
+    :return: array of P(out)
+    '''
+    in_votes = np.asarray(in_votes, dtype=float)
+    out_votes = np.asarray(out_votes, dtype=float)
+    filters_acc = np.asarray(filters_acc, dtype=float)
+    filters_select = np.asarray(filters_select, dtype=float)
+    if filter_index is not None:
+        filters_acc = filters_acc[filter_index]
+        filters_select = filters_select[filter_index]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_term_neg = xlogy(out_votes, filters_acc) + xlog1py(in_votes, -filters_acc) \
+                       + np.log(filters_select)
+        log_term_pos = xlogy(in_votes, filters_acc) + xlog1py(out_votes, -filters_acc) \
+                       + np.log1p(-filters_select)
+        pout = expit(log_term_neg - log_term_pos)
+
+    return pout
+
+
+def compute_stopping_rule(in_votes, out_votes, filters_acc, filters_select, out_threshold, n_max=10):
+    '''
+    Estimates, for each item-filter pair, the minimum number of consecutive OUT votes
+    needed to exclude the item and the joint probability of getting them.
+
+    :param in_votes: array of IN votes
+    :param out_votes: array of OUT votes
+    :param filters_acc: accuracy, broadcastable against the votes
+    :param filters_select: selectivity, broadcastable against the votes
+    :param out_threshold: P(out) needed to exclude an item
+    :param n_max: maximum number of votes considered
+    :return: n_min, joint_prob, classify_score arrays shaped as the votes
+    '''
+    in_votes = np.asarray(in_votes, dtype=float)
+    out_votes = np.asarray(out_votes, dtype=float)
+    filters_acc = np.asarray(filters_acc, dtype=float)
+    filters_select = np.asarray(filters_select, dtype=float)
+    shape = np.broadcast(in_votes, out_votes, filters_acc, filters_select).shape
+
+    # P(out) after n = 1..n_max further OUT votes, along a trailing axis
+    n = np.arange(1, n_max + 1)
+    acc = filters_acc[..., np.newaxis]
+    prob_item_neg = compute_pout(in_votes[..., np.newaxis], out_votes[..., np.newaxis] + n,
+                                 acc, filters_select[..., np.newaxis])
+    prob_item_neg = np.broadcast_to(prob_item_neg, shape + (n_max,))
+
+    # the n-th vote is negative given P(out) after n-1 votes (the selectivity for n = 1)
+    prob_item_neg_prev = np.concatenate(
+        [np.broadcast_to(filters_select, shape)[..., np.newaxis], prob_item_neg[..., :-1]], axis=-1)
+    prob_vote_neg = acc * prob_item_neg_prev + (1 - acc) * (1 - prob_item_neg_prev)
+    joint_prob_votes_neg = np.cumprod(prob_vote_neg, axis=-1)
+
+    # first n reaching the threshold, n_max otherwise
+    reached = prob_item_neg >= out_threshold
+    n_min_index = np.where(reached.any(axis=-1), reached.argmax(axis=-1), n_max - 1)
+    n_min = n_min_index + 1
+    joint_prob_flat = joint_prob_votes_neg.reshape(-1, n_max)
+    joint_prob = joint_prob_flat[np.arange(joint_prob_flat.shape[0]), n_min_index.ravel()].reshape(shape)
+    classify_score = joint_prob / n_min
+
+    return n_min, joint_prob, classify_score
+
+
+class StoppingRuleTable:
+    '''
+    Bounded memo of compute_stopping_rule, keyed on
+    (in_votes, out_votes, accuracy, selectivity, out_threshold). The vote counts of a
+    job take few distinct values, so a lookup evaluates the rule only for the keys
+    it has not seen yet. The least recently used keys are evicted past max_size.
+    '''
+
+    def __init__(self, max_size=100000, n_max=10):
+        self.max_size = max_size
+        self.n_max = n_max
+        # {key: (n_min, joint_prob, classify_score)}
+        self.table = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.table)
+
+    def lookup(self, in_votes, out_votes, filters_acc, filters_select, out_threshold):
+        '''
+        Same as compute_stopping_rule, with the parameters broadcast against the votes.
+        :return: n_min, joint_prob, classify_score arrays shaped as the votes
+        '''
+        if np.broadcast(in_votes, out_votes, filters_acc, filters_select).size == 0:
+            return compute_stopping_rule(in_votes, out_votes, filters_acc, filters_select, out_threshold, self.n_max)
+        in_votes = np.asarray(in_votes, dtype=np.int64)
+        out_votes = np.asarray(out_votes, dtype=np.int64)
+        # code the distinct (accuracy, selectivity) pairs before broadcasting them against the votes
+        filters_acc, filters_select = np.broadcast_arrays(np.asarray(filters_acc, dtype=float),
+                                                          np.asarray(filters_select, dtype=float))
+        params, params_code = np.unique(np.column_stack([filters_acc.ravel(), filters_select.ravel()]),
+                                        axis=0, return_inverse=True)
+        params_code = params_code.reshape(filters_acc.shape)
+        in_votes, out_votes, params_code = np.broadcast_arrays(in_votes, out_votes, params_code)
+        shape = in_votes.shape
+
+        # distinct (in_votes, out_votes, params) triples, as integer codes
+        in_num = int(in_votes.max()) + 1
+        out_num = int(out_votes.max()) + 1
+        codes = (params_code.ravel() * in_num + in_votes.ravel()) * out_num + out_votes.ravel()
+        codes, inverse = np.unique(codes, return_inverse=True)
+        params_index, votes_code = np.divmod(codes, in_num * out_num)
+        keys = np.column_stack([votes_code // out_num, votes_code % out_num, params[params_index]])
+
+        values = np.empty((len(keys), 3))
+        with self.lock:
+            missing = []
+            for key_index, key in enumerate(map(tuple, keys)):
+                key += (out_threshold,)
+                value = self.table.get(key)
+                if value is None:
+                    missing.append(key_index)
+                else:
+                    self.table.move_to_end(key)
+                    values[key_index] = value
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+
+            if missing:
+                n_min, joint_prob, classify_score = compute_stopping_rule(
+                    *keys[missing].T, out_threshold=out_threshold, n_max=self.n_max)
+                values[missing] = np.column_stack([n_min, joint_prob, classify_score])
+                for key_index in missing:
+                    self.table[tuple(keys[key_index]) + (out_threshold,)] = tuple(values[key_index])
+                while len(self.table) > self.max_size:
+                    self.table.popitem(last=False)
+
+        values = values[inverse.ravel()]
+        return (values[:, 0].astype(np.int64).reshape(shape), values[:, 1].reshape(shape),
+                values[:, 2].reshape(shape))
@@ -0,0 +1,109 @@
+import cProfile
+import os
+import pstats
+import re
+import time
+
+# categories of the profiled time, by the first matching fragment of the source path, or for
+# the functions built in C (filename '~'), by the first matching module of their label, e.g.
+# "<method 'execute' of 'psycopg2.extensions.cursor' objects>"
+CATEGORIES = (
+    ('sql', ('/psycopg2/', '/sqlalchemy/'), ('psycopg2', 'sqlalchemy')),
+    ('pandas', ('/pandas/',), ('pandas',)),
+    ('numpy', ('/numpy/', '/scipy/'), ('numpy', 'scipy')),
+    ('msr', ('/src/msr_box.py', '/src/posterior.py', '/src/votes.py', '/src/baseround/'), ()),
+)
+
+_BUILTIN_MODULES = [(category, re.compile(r"[ ']({})\.".format('|'.join(modules))))
+                    for category, _, modules in CATEGORIES if modules]
+
+
+def _category(filename, name=''):
+    if filename == '~':
+        for category, modules in _BUILTIN_MODULES:
+            if modules.search(name):
+                return category
+        return 'other'
+    filename = filename.replace(os.sep, '/')
+    for category, fragments, _ in CATEGORIES:
+        if any(fragment in filename for fragment in fragments):
+            return category
+    return 'other'
+
+
+def _function_category(stats, function, seen=None):
+    '''
+    :param stats: pstats.Stats
+    :param function: (filename, line, name) key of stats.stats
+    :param seen: functions already visited up the callers
+    :return: category of the function, a built-in of no known module (len, sorted, ..) takes the
+        category of the caller spending the most time in it, so that it counts with the code using it
+    '''
+    filename, _, name = function
+    category = _category(filename, name)
+    if category != 'other' or filename != '~':
+        return category
+    seen = seen or set()
+    seen.add(function)
+    # {caller: (primitive calls, calls, own time, cumulative time) of function called by caller}
+    callers = [(timing[2], caller) for caller, timing in stats.stats[function][4].items()
+               if caller not in seen and caller in stats.stats]
+    if not callers:
+        return category
+    return _function_category(stats, max(callers)[1], seen)
+
+
+def profile_call(func, *args, **kwargs):
+    '''
+    :param func: function to profile
+    :param args: arguments of func
+    :param kwargs: keyword arguments of func
+    :return: result of func, cProfile.Profile
+    '''
+    profiler = cProfile.Profile()
+    result = profiler.runcall(func, *args, **kwargs)
+    return result, profiler
+
+
+def summarize(profiler, top=20):
+    '''
+    :param profiler: cProfile.Profile that ran
+    :param top: number of functions listed
+    :return: dict with the total time, the time spent in each category (own time of the
+        functions of SQL drivers, pandas, numpy/scipy, MSR-Box math and the rest, the built-ins
+        counting with their module or their caller) and the
+        functions with the highest cumulative time
+    '''
+    stats = pstats.Stats(profiler)
+    categories = {category: 0. for category, _, _ in CATEGORIES}
+    categories['other'] = 0.
+    functions = []
+    # {(filename, line, name): (primitive calls, calls, own time, cumulative time, callers)}
+    for (filename, line, name), (_, calls, tottime, cumtime, _) in stats.stats.items():
+        categories[_function_category(stats, (filename, line, name))] += tottime
+        functions.append({
+            'function': '{}:{}({})'.format(filename, line, name),
+            'calls': calls,
+            'tottime': tottime,
+            'cumtime': cumtime
+        })
+    functions.sort(key=lambda f: f['cumtime'], reverse=True)
+
+    return {
+        'totalTime': stats.total_tt,
+        'categories': categories,
+        'top': functions[:top]
+    }
+
+
+def save(profiler, directory, name):
+    '''
+    :param profiler: cProfile.Profile that ran
+    :param directory: directory of the profiles
+    :param name: name of the profiled request, e.g. its endpoint
+    :return: path of the pstats file, readable with pstats or snakeviz
+    '''
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, '{}-{}-{}.prof'.format(name, int(time.time() * 1000), os.getpid()))
+    profiler.dump_stats(path)
+    return path
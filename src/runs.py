@@ -0,0 +1,273 @@
+import concurrent.futures
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from collections import deque
+from contextlib import contextmanager
+
+
+class RunError(Exception):
+    '''
+    Raised by a run that did not complete, the message is reported as its error.
+    '''
+
+
+class Run:
+    '''
+    A unit of work (classify, generate-tasks, ..) on a job, executed in the background.
+    '''
+
+    def __init__(self, job_id, kind):
+        self.run_id = uuid.uuid4().hex
+        self.job_id = job_id
+        self.kind = kind
+        # 'queued', 'running', 'done' or 'failed'
+        self.state = 'queued'
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # {'unit': 'chunks' or 'criteria', 'done': .., 'total': .. or None if unknown},
+        # as reported by the run
+        self.progress = None
+
+    @property
+    def finished(self):
+        return self.state in ('done', 'failed')
+
+    def to_dict(self):
+        run = {
+            'runId': self.run_id,
+            'jobId': self.job_id,
+            'kind': self.kind,
+            'state': self.state,
+            'progress': self.progress,
+            'createdAt': self.created_at,
+            'startedAt': self.started_at,
+            'finishedAt': self.finished_at
+        }
+        if self.state == 'done':
+            run['result'] = self.result
+        elif self.state == 'failed':
+            run['error'] = self.error
+        return run
+
+    @classmethod
+    def from_dict(cls, run_dict):
+        '''
+        :param run_dict: as returned by to_dict
+        :return: the Run
+        '''
+        run = cls(run_dict['jobId'], run_dict['kind'])
+        run.run_id = run_dict['runId']
+        run.state = run_dict['state']
+        run.progress = run_dict.get('progress')
+        run.created_at = run_dict['createdAt']
+        run.started_at = run_dict['startedAt']
+        run.finished_at = run_dict['finishedAt']
+        run.result = run_dict.get('result')
+        run.error = run_dict.get('error')
+        return run
+
+
+# the Run executed by the current thread of a RunQueue, and the queue
+_current = threading.local()
+
+
+def report_progress(done, total=None, unit='chunks'):
+    '''
+    Records the progress of the run executed by the calling thread, does nothing if the
+    thread is not executing a run, e.g. in a synchronous request.
+    :param done: number of units done
+    :param total: number of units in all, None if unknown
+    :param unit: what is counted, e.g. 'chunks' or 'criteria'
+    '''
+    run = getattr(_current, 'run', None)
+    if run is None:
+        return
+    run.progress = {'unit': unit, 'done': done, 'total': total}
+    _current.queue.save(run)
+
+
+class SingleFlight:
+    '''
+    Concurrent calls with the same key share a single execution: the first one executes
+    the function, the others wait for it and get the same result or exception.
+    '''
+
+    def __init__(self):
+        # {key: Future of the call in flight}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, func, *args):
+        '''
+        :param key: hashable identity of the call
+        :param func: function to execute
+        :param args: arguments of func
+        :return: result of func
+        '''
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                self.calls[key] = future
+        if not leader:
+            return future.result()
+
+        try:
+            result = func(*args)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+class RunQueue:
+    '''
+    Executes runs on a pool of threads. The runs of a job, as well as the synchronous
+    calls holding job_lock(), are executed one at a time, so that they never write the
+    backlog or the results of the job concurrently. The runs waiting for their job are
+    queued per job and only handed to the pool when the job is free, so they never hold
+    a thread while waiting. With a store, the runs are also saved in it on every change,
+    so that any process can report their status.
+    '''
+
+    def __init__(self, workers=2, max_finished=1000, executor=None, store=None):
+        '''
+        :param workers: number of threads executing the runs
+        :param max_finished: number of finished runs kept for the status requests
+        :param executor: optional concurrent.futures.Executor replacing the thread pool
+        :param store: optional object with save_run(run_dict) and get_run(run_id) methods,
+            e.g. the Database, shared by the processes
+        '''
+        self.executor = executor or concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.max_finished = max_finished
+        self.store = store
+        # {run_id: Run}, in submission order
+        self.runs = OrderedDict()
+        # {key: Run} of the runs not finished yet, submitted with a key
+        self.active = {}
+        # jobs with a run executing or a synchronous call holding job_lock()
+        self.busy = set()
+        # {job_id: deque of (run, func, args, key) waiting for the job}
+        self.pending = {}
+        # {job_id: number of synchronous calls waiting for the job}
+        self.waiting = {}
+        self.lock = threading.Lock()
+        self.job_free = threading.Condition(self.lock)
+
+    @contextmanager
+    def job_lock(self, job_id):
+        '''
+        Executes the block when no run of the job is executing, the queued runs wait for it.
+        :param job_id:
+        '''
+        with self.lock:
+            self.waiting[job_id] = self.waiting.get(job_id, 0) + 1
+            while job_id in self.busy:
+                self.job_free.wait()
+            self.waiting[job_id] -= 1
+            if not self.waiting[job_id]:
+                del self.waiting[job_id]
+            self.busy.add(job_id)
+        try:
+            yield
+        finally:
+            self._release(job_id)
+
+    def submit(self, job_id, kind, func, *args, key=None):
+        '''
+        :param job_id:
+        :param kind: name of the work, e.g. 'classify'
+        :param func: function executing the run, its return value is the result of the run
+        :param args: arguments of func
+        :param key: optional identity of the run, a run with the same key that is not
+            finished yet is returned instead of queuing a new one
+        :return: the queued Run
+        '''
+        with self.lock:
+            if key is not None and key in self.active:
+                return self.active[key]
+            run = Run(job_id, kind)
+            self.runs[run.run_id] = run
+            if key is not None:
+                self.active[key] = run
+            self._evict()
+            start = job_id not in self.busy
+            if start:
+                self.busy.add(job_id)
+            else:
+                self.pending.setdefault(job_id, deque()).append((run, func, args, key))
+        try:
+            self.save(run)
+        finally:
+            if start:
+                self.executor.submit(self._execute, run, func, args, key)
+        return run
+
+    def get(self, run_id):
+        '''
+        :param run_id:
+        :return: the Run, from the store if it is not one of this process, None if unknown or evicted
+        '''
+        with self.lock:
+            run = self.runs.get(run_id)
+        if run is None and self.store is not None and run_id:
+            run_dict = self.store.get_run(run_id)
+            if run_dict is not None:
+                run = Run.from_dict(run_dict)
+        return run
+
+    def save(self, run):
+        if self.store is not None:
+            self.store.save_run(run.to_dict())
+
+    def _execute(self, run, func, args, key=None):
+        _current.run, _current.queue = run, self
+        run.started_at = time.time()
+        run.state = 'running'
+        try:
+            self.save(run)
+            run.result = func(*args)
+            run.state = 'done'
+        except Exception as e:
+            run.error = str(e) or e.__class__.__name__
+            run.state = 'failed'
+        finally:
+            _current.run, _current.queue = None, None
+            run.finished_at = time.time()
+            if key is not None:
+                with self.lock:
+                    self.active.pop(key, None)
+            try:
+                self.save(run)
+            finally:
+                self._release(run.job_id)
+
+    def _release(self, job_id):
+        next_run = None
+        with self.lock:
+            job_pending = self.pending.get(job_id)
+            # the synchronous calls waiting for the job go first
+            if job_pending and job_id not in self.waiting:
+                next_run = job_pending.popleft()
+                if not job_pending:
+                    del self.pending[job_id]
+            else:
+                self.busy.discard(job_id)
+                self.job_free.notify_all()
+        if next_run is not None:
+            self.executor.submit(self._execute, *next_run)
+
+    def _evict(self):
+        finished = [run_id for run_id, run in self.runs.items() if run.finished]
+        for run_id in finished[:max(len(finished) - self.max_finished, 0)]:
+            del self.runs[run_id]
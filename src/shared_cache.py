@@ -0,0 +1,140 @@
+import fcntl
+import glob
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import numpy as np
+
+from src.votes import VoteTensor
+
+
+class SharedJobCache:
+    '''
+    Per-job cache shared by the processes of a host through files, e.g. in /dev/shm.
+    Each job has a version counter in a memory mapped file, every write to the backlog
+    or to the results of the job bumps it and the entries cached at an older version
+    are ignored. The metadata of a job (project, criteria, votes per task) is a small
+    JSON file, loaded again after max_age seconds since the job and its criteria can be
+    edited outside MSR-Box. The vote matrices are .npy files read with mmap_mode, so
+    their pages are shared by all the processes instead of being copied in each one.
+    '''
+
+    def __init__(self, directory, max_age=60.):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # seconds after which the metadata of a job is loaded again
+        self.max_age = max_age
+        # {job_id: mmap of the version file}, opened once per process
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _version_map(self, job_id):
+        with self.lock:
+            if job_id not in self.versions:
+                fd = os.open(self._path('job-{}.version'.format(job_id)), os.O_RDWR | os.O_CREAT)
+                try:
+                    if os.fstat(fd).st_size < 8:
+                        os.ftruncate(fd, 8)
+                    self.versions[job_id] = mmap.mmap(fd, 8)
+                finally:
+                    os.close(fd)
+            return self.versions[job_id]
+
+    def version(self, job_id):
+        '''
+        :param job_id:
+        :return: current version of the cached state of the job
+        '''
+        return struct.unpack('<q', self._version_map(job_id)[:8])[0]
+
+    def bump(self, job_id):
+        '''
+        Invalidates the entries of the job in all the processes.
+        :param job_id:
+        :return: the new version
+        '''
+        version_map = self._version_map(job_id)
+        with open(self._path('job-{}.lock'.format(job_id)), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            version = struct.unpack('<q', version_map[:8])[0] + 1
+            version_map[:8] = struct.pack('<q', version)
+        return version
+
+    def _write_atomic(self, path, write):
+        fd, path_tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(path_tmp, path)
+        except:
+            os.remove(path_tmp)
+            raise
+
+    def get_meta(self, job_id, key, load):
+        '''
+        :param job_id:
+        :param key: name of the metadata, e.g. 'filters'
+        :param load: function returning the value (JSON serializable) on a miss
+        :return: the value of the metadata
+        '''
+        path = self._path('job-{}.json'.format(job_id))
+        version = self.version(job_id)
+        try:
+            with open(path) as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            meta = {}
+        if meta.get('version') != version or time.time() - meta.get('loaded_at', 0) > self.max_age:
+            meta = {'version': version, 'loaded_at': time.time()}
+        if key not in meta:
+            meta[key] = load()
+            self._write_atomic(path, lambda f: f.write(json.dumps(meta).encode()))
+        return meta[key]
+
+    def drop_meta(self, job_id):
+        '''
+        Forces the metadata of the job to be loaded again on the next get_meta().
+        :param job_id:
+        '''
+        try:
+            os.remove(self._path('job-{}.json'.format(job_id)))
+        except OSError:
+            pass
+
+    def get_votes(self, job_id, fingerprint, load):
+        '''
+        :param job_id:
+        :param fingerprint: string identifying the votes of the job, e.g. built from the answered tasks
+        :param load: function returning the VoteTensor on a miss
+        :return: VoteTensor, its arrays are read-only memory maps on a hit
+        '''
+        prefix = self._path('job-{}-votes-'.format(job_id))
+        key = '{}{}-{}'.format(prefix, self.version(job_id), fingerprint)
+        try:
+            # the votes are written last, if they are there the entry is complete
+            votes = np.load(key + '.votes.npy', mmap_mode='r')
+            item_ids = np.load(key + '.items.npy', mmap_mode='r')
+            filter_ids = np.load(key + '.filters.npy')
+            return VoteTensor(item_ids, filter_ids, votes)
+        except IOError:
+            pass
+
+        items_votes = load()
+        self._write_atomic(key + '.items.npy', lambda f: np.save(f, np.asarray(items_votes.item_ids, dtype=np.int64)))
+        self._write_atomic(key + '.filters.npy', lambda f: np.save(f, np.asarray(items_votes.filter_ids, dtype=np.int64)))
+        self._write_atomic(key + '.votes.npy', lambda f: np.save(f, items_votes.votes))
+        # drop the older entries, the processes still reading them keep their maps
+        for path in glob.glob(prefix + '*.npy'):
+            if not path.startswith(key + '.'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        return items_votes
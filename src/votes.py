@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+
+
+class VoteTensor:
+    '''
+    Dense (item x filter x {in, out}) vote counts of a job.
+    votes[item_index, filter_index] == [in_votes, out_votes]
+    '''
+
+    def __init__(self, item_ids, filter_ids, votes):
+        self.item_ids = [int(i) for i in item_ids]
+        self.filter_ids = [int(i) for i in filter_ids]
+        self.votes = votes
+        # item_map {item_id in DB: index_in_tensor}
+        self.item_map = {item_id: item_index for item_index, item_id in enumerate(self.item_ids)}
+        # filter_map {filter_id in DB: index_in_tensor}
+        self.filter_map = {filter_id: filter_index for filter_index, filter_id in enumerate(self.filter_ids)}
+
+    @property
+    def in_votes(self):
+        return self.votes[:, :, 0]
+
+    @property
+    def out_votes(self):
+        return self.votes[:, :, 1]
+
+    def __len__(self):
+        return len(self.item_ids)
+
+    @classmethod
+    def from_frame(cls, items_votes_data, filter_list):
+        '''
+        :param items_votes_data: DataFrame with id, criteria_id, in_votes, out_votes columns
+        :param filter_list: list of filter ids, it defines the order of the filter axis
+        :return: VoteTensor, items keep the order of their first appearance in the frame
+        '''
+        item_codes, item_ids = pd.factorize(items_votes_data['id'], sort=False)
+        filter_codes = pd.Index(filter_list).get_indexer(items_votes_data['criteria_id'])
+        in_votes = items_votes_data['in_votes'].values
+        out_votes = items_votes_data['out_votes'].values
+
+        # drop votes of filters not in filter_list
+        known = filter_codes >= 0
+        item_codes, filter_codes = item_codes[known], filter_codes[known]
+        in_votes, out_votes = in_votes[known], out_votes[known]
+
+        # use the smallest unsigned type able to hold the vote counts
+        max_votes = max(in_votes.max(), out_votes.max()) if len(in_votes) else 0
+        dtype = np.min_scalar_type(int(max_votes))
+        votes = np.zeros((len(item_ids), len(filter_list), 2), dtype=dtype)
+        votes[item_codes, filter_codes, 0] = in_votes
+        votes[item_codes, filter_codes, 1] = out_votes
+
+        return cls(item_ids, filter_list, votes)
@@ -0,0 +1,77 @@
+import threading
+import numpy as np
+
+
+class TaskWatermark:
+    '''
+    Position of a reader of the answers in the task table of a job: the highest task id
+    read, and the ids of the tasks up to it that were not answered yet. Those are read
+    again until they are answered, so the answers arriving late are not lost and a task
+    that is never answered does not hold the others back. A task is given up once
+    max_pending_span tasks were created after it, so that the pending ids of the tasks
+    never answered do not pile up in the queries.
+    '''
+
+    max_pending_span = 10000
+
+    def __init__(self, task_id=0, pending_task_ids=()):
+        self.task_id = task_id
+        self.pending_task_ids = frozenset(pending_task_ids)
+
+    def sql_filter(self, column='t.id'):
+        '''
+        :param column: task id column of the query
+        :return: SQL condition selecting the tasks not read yet
+        '''
+        if not self.pending_task_ids:
+            return '{} > {}'.format(column, self.task_id)
+        return '({} > {} or {} in ({}))'.format(column, self.task_id, column,
+                                                ', '.join(str(i) for i in sorted(self.pending_task_ids)))
+
+    def after(self, task_ids, answered):
+        '''
+        :param task_ids: ids of the tasks selected by sql_filter()
+        :param answered: whether each of them is answered, aligned with task_ids
+        :return: the TaskWatermark past those tasks
+        '''
+        task_ids = np.asarray(task_ids, dtype=np.int64)
+        answered = np.asarray(answered, dtype=bool)
+        task_id = max(self.task_id, int(task_ids.max())) if len(task_ids) else self.task_id
+        pending_task_ids = task_ids[~answered]
+        return TaskWatermark(task_id, pending_task_ids[pending_task_ids > task_id - self.max_pending_span].tolist())
+
+
+class ClassificationWatermark:
+    '''
+    TaskWatermark of the answers already taken into account by the classification of
+    a job, with the parameters it was computed with. The items without answers after
+    the watermark keep the outcome of the previous classification as long as the
+    parameters do not change.
+    '''
+
+    def __init__(self):
+        # TaskWatermark of the answers classified, None before the first classification
+        self.tasks = None
+        # (criteria parameters, out_threshold, in_threshold) of the last classification
+        self.params = None
+        # classifications of the job run one at a time
+        self.lock = threading.Lock()
+
+    def reset(self):
+        self.tasks = None
+        self.params = None
+
+
+_watermarks = {}
+_watermarks_lock = threading.Lock()
+
+
+def get_classification_watermark(job_id):
+    '''
+    :param job_id:
+    :return: the ClassificationWatermark of the job, created on first use
+    '''
+    with _watermarks_lock:
+        if job_id not in _watermarks:
+            _watermarks[job_id] = ClassificationWatermark()
+        return _watermarks[job_id]
@@ -0,0 +1,104 @@
+import json
+import os
+import pytest
+
+from src.db import Database
+
+# scratch database of the tests that need PostgreSQL, its tables are dropped and created again,
+# the connection settings are the PG* variables read by src.flask_app
+TEST_DATABASE = os.getenv('MSR_TEST_PGDATABASE')
+
+# stand-ins of the CrowdRev tables and SQL functions used by MSR-Box
+SQL_SCHEMA = '''
+    drop table if exists project, job, item, criterion, task, backlog, result,
+        msr_item_votes, msr_vote_watermark, msr_counted_tasks, msr_task_leases, msr_runs cascade;
+    create table project (id bigserial primary key);
+    create table job (id bigserial primary key, project_id bigint, data jsonb);
+    create table item (id bigserial primary key, project_id bigint);
+    create table criterion (id bigserial primary key, project_id bigint);
+    create table task (id bigserial primary key, job_id bigint, item_id bigint, worker_id bigint, data jsonb);
+    create table backlog (id bigserial primary key, job_id bigint, item_id bigint, criterion_id bigint, step int);
+    create table result (id bigserial primary key, job_id bigint, item_id bigint, created_at timestamp, data jsonb);
+    create or replace function compute_item_entries(job bigint, item bigint, criterion bigint) returns bigint as $$
+        select count(*) from task t, jsonb_array_elements(t.data -> 'criteria') tc
+        where t.job_id = job and t.item_id = item and (tc ->> 'id')::bigint = criterion
+    $$ language sql;
+    create or replace function compute_item_entries_step(job bigint, item bigint, criterion bigint, step int)
+    returns bigint as $$
+        select count(*) from task t, jsonb_array_elements(t.data -> 'criteria') tc
+        where t.job_id = job and t.item_id = item and (tc ->> 'id')::bigint = criterion
+            and (t.data ->> 'step')::int = step
+    $$ language sql;
+    create or replace function compute_item_in_out_votes(job bigint, item bigint, criterion bigint, answer text)
+    returns bigint as $$
+        select count(*) from task t, jsonb_array_elements(t.data -> 'criteria') tc
+        where t.job_id = job and t.item_id = item and (tc ->> 'id')::bigint = criterion
+            and tc ->> 'workerAnswer' = answer
+    $$ language sql;
+    '''
+
+
+class JobFixture:
+    '''
+    Writes a job of a project with its items and criteria, and the tasks of its workers.
+    '''
+
+    def __init__(self, db, items_num=4, filter_ids=(10, 11), max_votes=3):
+        self.db = db
+        self.job_id = 1
+        self.filter_ids = list(filter_ids)
+        self.item_ids = list(range(1, items_num + 1))
+        db.con.execute('insert into project (id) values (1);')
+        db.con.execute("insert into job (id, project_id, data) values (1, 1, %s);",
+                       json.dumps({'votesPerTaskRule': max_votes}))
+        for item_id in self.item_ids:
+            db.con.execute('insert into item (id, project_id) values (%s, 1);', item_id)
+        for filter_id in self.filter_ids:
+            db.con.execute('insert into criterion (id, project_id) values (%s, 1);', filter_id)
+
+    def add_task(self, item_id, worker_id, votes=None, filter_ids=None):
+        '''
+        :param item_id:
+        :param worker_id:
+        :param votes: 'yes'/'no' per criterion of the task, None for a task not answered yet
+        :param filter_ids: criteria of the task, all the criteria by default
+        :return: task id
+        '''
+        criteria = [{'id': filter_id} for filter_id in filter_ids or self.filter_ids]
+        if votes is not None:
+            for criterion, vote in zip(criteria, votes):
+                criterion['workerAnswer'] = vote
+        return self.db.con.execute(
+            'insert into task (job_id, item_id, worker_id, data) values (%s, %s, %s, %s) returning id;',
+            self.job_id, item_id, worker_id, json.dumps({'answered': votes is not None, 'criteria': criteria})
+        ).scalar()
+
+    def answer_task(self, task_id, votes):
+        data = self.db.con.execute('select data from task where id = %s;', task_id).scalar()
+        for criterion, vote in zip(data['criteria'], votes):
+            criterion['workerAnswer'] = vote
+        data['answered'] = True
+        self.db.con.execute('update task set data = %s where id = %s;', json.dumps(data), task_id)
+
+    def add_backlog(self, step=0):
+        for item_id in self.item_ids:
+            for filter_id in self.filter_ids:
+                self.db.con.execute(
+                    'insert into backlog (job_id, item_id, criterion_id, step) values (%s, %s, %s, %s);',
+                    self.job_id, item_id, filter_id, step)
+
+
+@pytest.fixture
+def db():
+    if not TEST_DATABASE:
+        pytest.skip('MSR_TEST_PGDATABASE is not set')
+    db = Database(os.getenv('PGUSER') or 'postgres', os.getenv('PGPASSWORD') or 'postgres', TEST_DATABASE,
+                  os.getenv('PGHOST') or 'localhost', os.getenv('PGPORT') or 5432, vote_query='table')
+    db.con.execute(SQL_SCHEMA)
+    yield db
+    db.con.dispose()
+
+
+@pytest.fixture
+def job(db):
+    return JobFixture(db)
@@ -0,0 +1,76 @@
+import numpy as np
+
+from src.baseround.aggregation import expectation_maximization
+from src.baseround.aggregation import expectation_maximization_sparse
+from src.baseround.aggregation import psi_to_coo
+
+
+def simulate_votes(rng, workers_num, items_num, votes_per_item):
+    '''
+    :return: Psi with binary votes of workers of random accuracies on items of random truth,
+        the workers renumbered so that they all vote, and the number of workers
+    '''
+    truth = rng.randint(0, 2, items_num)
+    acc = rng.uniform(0.5, 0.95, workers_num)
+    Psi = []
+    for obj in range(items_num):
+        workers = rng.choice(workers_num, size=min(votes_per_item, workers_num), replace=False)
+        Psi.append([(int(s), int(truth[obj] if rng.uniform() < acc[s] else 1 - truth[obj])) for s in workers])
+    workers_voting = sorted({s for x in Psi for s, _ in x})
+    worker_pos = {s: i for i, s in enumerate(workers_voting)}
+    Psi = [[(worker_pos[s], val) for s, val in x] for x in Psi]
+    return Psi, len(workers_voting)
+
+
+def assert_same_estimates(A, p, A_sparse, p_sparse):
+    assert np.allclose(A, A_sparse, equal_nan=True)
+    for obj in range(len(p)):
+        assert np.isclose(p[obj][0], p_sparse[obj][0]) and np.isclose(p[obj][1], p_sparse[obj][1])
+
+
+def test_sparse_em_matches_em():
+    rng = np.random.RandomState(1)
+    for _ in range(100):
+        Psi, N = simulate_votes(rng, rng.randint(1, 12), rng.randint(1, 30), rng.randint(1, 5))
+        M = len(Psi)
+        try:
+            A, p, info = expectation_maximization(N, M, [list(x) for x in Psi], return_info=True)
+        except ZeroDivisionError:
+            # expectation_maximization divides by zero on some degenerate jobs
+            continue
+        A_sparse, p_sparse, info_sparse = expectation_maximization_sparse(N, M, *psi_to_coo(Psi), return_info=True)
+
+        assert_same_estimates(A, p, A_sparse, p_sparse)
+        assert info_sparse['iterations'] == info['iterations']
+        assert info_sparse['converged'] == info['converged']
+
+
+def test_sparse_em_matches_em_warm_start():
+    rng = np.random.RandomState(2)
+    Psi, N = simulate_votes(rng, 20, 200, 4)
+    M = len(Psi)
+    A_init = rng.uniform(0.6, 0.9, N)
+    A_init[::3] = np.nan
+
+    A, p = expectation_maximization(N, M, [list(x) for x in Psi], A_init=A_init)
+    A_sparse, p_sparse = expectation_maximization_sparse(N, M, *psi_to_coo(Psi), A_init=A_init)
+
+    assert_same_estimates(A, p, A_sparse, p_sparse)
+
+
+def test_squarem_matches_em():
+    rng = np.random.RandomState(4)
+    eps = 0.001
+    for _ in range(10):
+        Psi, N = simulate_votes(rng, 20, 300, 4)
+        M = len(Psi)
+        coo = psi_to_coo(Psi)
+        # run both close to the fixed point, their accuracies agree within the default tolerance
+        A, p, info = expectation_maximization_sparse(N, M, *coo, return_info=True, eps=eps ** 2, it_max=1000)
+        A_squarem, p_squarem, info_squarem = expectation_maximization_sparse(
+            N, M, *coo, return_info=True, eps=eps ** 2, it_max=1000, acceleration='squarem')
+
+        assert info['converged'] is True and info_squarem['converged'] is True
+        assert info_squarem['iterations'] <= info['iterations']
+        assert np.nanmax(np.abs(np.array(A_squarem) - np.array(A))) < eps
+        assert np.abs(p_squarem - p).max() < eps
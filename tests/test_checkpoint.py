@@ -0,0 +1,30 @@
+import os
+import threading
+import numpy as np
+
+from src.baseround.checkpoint import EMCheckpoint
+
+
+def test_concurrent_saves_of_a_criterion(tmpdir):
+    checkpoint = EMCheckpoint(str(tmpdir))
+    errors = []
+
+    def save(thread_num):
+        try:
+            for _ in range(20):
+                acc = np.full(100, thread_num / 10.)
+                checkpoint.save(1, 10, np.arange(100), acc, np.arange(500), np.full(500, thread_num / 10.))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=save, args=(thread_num,)) for thread_num in range(1, 9)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    # the checkpoint is the complete one of a single save
+    saved = checkpoint.load(1, 10)
+    assert len(np.unique(saved['acc'])) == 1 and np.all(saved['p_out'] == saved['acc'][0])
+    assert os.listdir(str(tmpdir)) == ['em-1-10.npz']
@@ -0,0 +1,147 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.db import VOTE_QUERIES
+from src.runs import RunQueue
+from tests.conftest import JobFixture
+
+
+def read_items_votes(db, job_id, vote_query, **kwargs):
+    sql_items_votes = db._sql_items_votes(job_id, db.get_project_id(job_id), vote_query=vote_query,
+                                          with_entries=True, **kwargs)
+    items_votes_data = pd.read_sql(sql_items_votes, db.con)
+    return items_votes_data.sort_values(['id', 'criteria_id']).reset_index(drop=True).astype('int64')
+
+
+def test_vote_queries_are_equivalent(db, job):
+    job.add_task(1, 1, ['yes', 'no'])
+    job.add_task(1, 2, ['no', 'no'])
+    # unanswered tasks count as entries only
+    job.add_task(2, 1)
+    job.add_task(3, 3)
+    # task on a single criterion
+    job.add_task(2, 2, ['yes'], filter_ids=[11])
+    pending_task_id = job.add_task(3, 2)
+    db.refresh_vote_counts(job.job_id)
+    # answered after the first refresh
+    job.answer_task(pending_task_id, ['yes', 'yes'])
+    job.add_task(4, 4, ['no', 'yes'])
+    db.refresh_vote_counts(job.job_id)
+
+    items_votes = {vote_query: read_items_votes(db, job.job_id, vote_query) for vote_query in VOTE_QUERIES}
+
+    expected = items_votes['function']
+    assert expected['entries'].sum() == 13
+    assert expected['in_votes'].sum() == 5 and expected['out_votes'].sum() == 4
+    for vote_query in VOTE_QUERIES:
+        pd.testing.assert_frame_equal(items_votes[vote_query], expected)
+    assert db.compare_vote_queries(job.job_id).empty
+
+
+def test_vote_queries_voted_only_and_exclude_classified(db, job):
+    job.add_task(1, 1, ['yes', 'no'])
+    job.add_task(2, 1, ['no'], filter_ids=[10])
+    job.add_task(3, 1)
+    db.con.execute("insert into result (job_id, item_id, created_at, data) values (1, 2, now(), '{}');")
+    db.refresh_vote_counts(job.job_id)
+
+    for kwargs in ({'voted_only': True}, {'exclude_classified': True}):
+        items_votes = {vote_query: read_items_votes(db, job.job_id, vote_query, **kwargs)
+                       for vote_query in VOTE_QUERIES}
+        for vote_query in VOTE_QUERIES:
+            pd.testing.assert_frame_equal(items_votes[vote_query], items_votes['function'])
+
+
+def test_refresh_vote_counts_recounts_job_without_watermark(db, job):
+    job.add_task(1, 1, ['yes', 'no'])
+    pending_task_id = job.add_task(2, 1)
+    db.refresh_vote_counts(job.job_id)
+    assert db.con.execute('select task_id, pending_task_ids from msr_vote_watermark where job_id = 1;').first() \
+        == (pending_task_id, [pending_task_id])
+
+    # counts of another job, and of this job before its watermark was kept
+    db.con.execute('insert into msr_item_votes (job_id, item_id, criterion_id, in_votes, last_task_id) '
+                   'values (2, 1, 10, 7, 1);')
+    db.con.execute('update msr_item_votes set in_votes = in_votes + 5 where job_id = 1;')
+    db.con.execute('delete from msr_vote_watermark where job_id = 1;')
+    job.answer_task(pending_task_id, ['no', 'no'])
+    db.refresh_vote_counts(job.job_id)
+
+    assert db.compare_vote_queries(job.job_id).empty
+    assert db.con.execute('select in_votes from msr_item_votes where job_id = 2;').scalar() == 7
+    assert db.con.execute('select pending_task_ids from msr_vote_watermark where job_id = 1;').scalar() == []
+
+
+def test_compare_vote_queries_without_table(db, job):
+    job.add_task(1, 1, ['yes', 'no'])
+    job.add_task(2, 1)
+    db.vote_query = 'function'
+
+    assert db.compare_vote_queries(job.job_id).empty
+    assert db.con.execute("select to_regclass('msr_item_votes');").scalar() is None
+
+
+def test_items_chunks_do_not_split_items(db):
+    job = JobFixture(db, items_num=7, filter_ids=(10, 11, 12))
+    # items voted on a varying number of criteria, so their rows differ in number
+    for item_id in job.item_ids:
+        job.add_task(item_id, 1, ['yes', 'no', 'yes'][:item_id % 3 + 1],
+                     filter_ids=job.filter_ids[:item_id % 3 + 1])
+    sql_items_votes = db._sql_items_votes(job.job_id, db.get_project_id(job.job_id), voted_only=True,
+                                          vote_query='groupby')
+    expected = pd.read_sql(sql_items_votes, db.con).sort_values(['id', 'criteria_id']).reset_index(drop=True)
+
+    for chunk_rows in range(1, 8):
+        chunks = list(db._read_items_chunks(sql_items_votes, chunk_rows))
+        chunk_items = [set(chunk['id']) for chunk in chunks]
+        assert sum(len(item_ids) for item_ids in chunk_items) == len(set.union(*chunk_items))
+        pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), expected)
+
+
+def test_iter_items_tolabel_matches_get_items_tolabel(db):
+    job = JobFixture(db, items_num=9)
+    for item_id in job.item_ids:
+        job.add_task(item_id, 1, ['yes', 'no'])
+        job.add_task(item_id, 2, ['no', 'no'][:item_id % 2 + 1], filter_ids=job.filter_ids[:item_id % 2 + 1])
+    db.con.execute("insert into result (job_id, item_id, created_at, data) values (1, 3, now(), '{}');")
+
+    items_votes = db.get_items_tolabel_msr(job.job_id, as_tensor=True)
+    chunks = list(db.iter_items_tolabel_msr(job.job_id, 2, as_tensor=True))
+
+    assert np.array_equal(np.concatenate([chunk.item_ids for chunk in chunks]), items_votes.item_ids)
+    assert np.array_equal(np.concatenate([chunk.votes for chunk in chunks]), items_votes.votes)
+    assert 3 not in items_votes.item_ids
+
+
+def test_runs_are_shared_through_the_database(db):
+    run_queue = RunQueue(workers=1, store=db)
+    run = run_queue.submit(1, 'classify', lambda: {'message': 'classified'})
+    for _ in range(500):
+        if run.finished:
+            break
+        time.sleep(0.01)
+
+    # the queue of another process reads the run from the table
+    run_status = RunQueue(workers=1, store=db).get(run.run_id).to_dict()
+    assert run_status == run.to_dict()
+    assert db.get_run('unknown') is None
+
+
+def test_votes_fingerprint_changes_with_results(db, job):
+    job.add_task(1, 1, ['yes', 'no'])
+    fingerprint = db.get_votes_fingerprint(job.job_id)
+    assert db.get_votes_fingerprint(job.job_id) == fingerprint
+
+    # classifying an item changes the votes of exclude_classified, not the answers
+    db.con.execute("insert into result (job_id, item_id, created_at, data) values (%s, %s, now(), '{}');",
+                   job.job_id, job.item_ids[0])
+    classified = db.get_votes_fingerprint(job.job_id)
+    assert classified != fingerprint
+
+    # a result replaced by another keeps the count but not the max id
+    db.con.execute('delete from result where job_id = %s;', job.job_id)
+    db.con.execute("insert into result (job_id, item_id, created_at, data) values (%s, %s, now(), '{}');",
+                   job.job_id, job.item_ids[1])
+    assert db.get_votes_fingerprint(job.job_id) not in (fingerprint, classified)
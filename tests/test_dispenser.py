@@ -0,0 +1,66 @@
+import pytest
+
+from src.dispenser import TaskDispenser
+from src.dispenser import get_dispenser
+from tests.conftest import JobFixture
+
+
+def capacity(dispenser, item_id, filter_id):
+    return dispenser.capacity[filter_id][dispenser.item_index[filter_id][item_id]]
+
+
+@pytest.mark.parametrize('vote_query', ['function', 'table'])
+def test_each_task_takes_one_vote(db, job, vote_query):
+    db.vote_query = vote_query
+    job.add_backlog()
+    job.add_task(1, 1, ['yes', 'no'])
+    in_flight_task_id = job.add_task(1, 2)
+    dispenser = TaskDispenser(db, job.job_id, max_age=60.)
+    dispenser.get_tasks(3, 1)
+    assert capacity(dispenser, 1, 10) == 1
+
+    # the task in flight at the load is already counted
+    job.answer_task(in_flight_task_id, ['no', 'no'])
+    dispenser.record_answer(2, 1, 10)
+    dispenser.get_tasks(3, 1)
+    assert capacity(dispenser, 1, 10) == 1
+
+    # a task created after the load is counted once, when it is created
+    task_id = job.add_task(1, 3)
+    dispenser.get_tasks(4, 1)
+    assert capacity(dispenser, 1, 10) == 0
+    job.answer_task(task_id, ['yes', 'yes'])
+    dispenser.record_answer(3, 1, 10)
+    dispenser.get_tasks(4, 1)
+    assert capacity(dispenser, 1, 10) == 0 and capacity(dispenser, 2, 11) == 3
+
+    dispenser.load()
+    assert capacity(dispenser, 1, 10) == 0 and capacity(dispenser, 2, 11) == 3
+
+
+def test_leases_are_shared_by_the_processes(db):
+    job = JobFixture(db, items_num=2, filter_ids=[10], max_votes=1)
+    job.add_backlog()
+    # the dispensers of two processes
+    dispenser_1 = TaskDispenser(db, job.job_id, max_age=60., lease_ttl=60.)
+    dispenser_2 = TaskDispenser(db, job.job_id, max_age=60., lease_ttl=60.)
+
+    assert dispenser_1.get_tasks(1, 2) == ([1, 2], [10])
+    assert dispenser_2.get_tasks(2, 2) == ([], [])
+
+    # the task ends the lease and takes the vote
+    job.add_task(1, 1, filter_ids=[10])
+    assert dispenser_2.get_tasks(2, 2) == ([], [])
+    assert db.con.execute('select item_id from msr_task_leases;').fetchall() == [(2,)]
+
+    db.con.execute("update msr_task_leases set expires_at = now() - interval '1 second';")
+    assert dispenser_2.get_tasks(2, 2) == ([2], [10])
+    assert dispenser_1.get_tasks(1, 2) == ([], [])
+
+
+def test_idle_dispensers_are_evicted(db, job):
+    dispenser = get_dispenser(db, job.job_id)
+    assert get_dispenser(db, job.job_id) is dispenser
+    dispenser.used_at -= 60.
+    assert get_dispenser(db, 2, max_idle=30.) is not dispenser
+    assert get_dispenser(db, job.job_id) is not dispenser
@@ -0,0 +1,117 @@
+import numpy as np
+from scipy.special import binom
+
+from src.posterior import compute_pout
+from src.posterior import compute_stopping_rule
+from src.posterior import StoppingRuleTable
+
+
+def pout_loop(pos_c, neg_c, filter_acc, filter_select):
+    # P(out) of an item-filter pair as computed by ClassificationMSR.classify before the batched engine
+    term_neg = binom(pos_c + neg_c, neg_c) * filter_acc ** (neg_c) \
+               * (1 - filter_acc) ** pos_c * filter_select
+    term_pos = binom(pos_c + neg_c, pos_c) * filter_acc ** pos_c \
+               * (1 - filter_acc) ** (neg_c) * (1 - filter_select)
+    return term_neg / (term_neg + term_pos)
+
+
+def stopping_rule_loop(pos_c, neg_c, filter_acc, filter_select, out_threshold):
+    # n_min and joint prob of an item-filter pair as computed by FilterAssignment.assign_filters
+    # before the batched engine
+    joint_prob_votes_neg = 1.
+    prob_item_neg = filter_select
+    for n in range(1, 11):
+        prob_vote_neg = filter_acc * prob_item_neg + (1 - filter_acc) * (1 - prob_item_neg)
+        joint_prob_votes_neg *= prob_vote_neg
+        prob_item_neg = pout_loop(pos_c, neg_c + n, filter_acc, filter_select)
+        if prob_item_neg >= out_threshold:
+            return n, joint_prob_votes_neg
+    return 10, joint_prob_votes_neg
+
+
+def random_votes(rng, items_num, filters_num, max_votes=8):
+    in_votes = rng.randint(0, max_votes, size=(items_num, filters_num))
+    out_votes = rng.randint(0, max_votes, size=(items_num, filters_num))
+    filters_acc = rng.uniform(0.55, 0.95, size=filters_num)
+    filters_select = rng.uniform(0.05, 0.95, size=filters_num)
+    return in_votes, out_votes, filters_acc, filters_select
+
+
+def test_compute_pout_matches_loop():
+    rng = np.random.RandomState(0)
+    in_votes, out_votes, filters_acc, filters_select = random_votes(rng, 50, 4)
+
+    pout = compute_pout(in_votes, out_votes, filters_acc, filters_select)
+
+    for item_index in range(in_votes.shape[0]):
+        for filter_index in range(in_votes.shape[1]):
+            expected = pout_loop(in_votes[item_index, filter_index], out_votes[item_index, filter_index],
+                                 filters_acc[filter_index], filters_select[filter_index])
+            assert np.isclose(pout[item_index, filter_index], expected)
+
+
+def test_compute_pout_filter_index_matches_broadcast():
+    rng = np.random.RandomState(1)
+    in_votes, out_votes, filters_acc, filters_select = random_votes(rng, 30, 3)
+    filter_index = np.tile(np.arange(3), (30, 1))
+
+    pout = compute_pout(in_votes.ravel(), out_votes.ravel(), filters_acc, filters_select, filter_index.ravel())
+
+    assert np.allclose(pout, compute_pout(in_votes, out_votes, filters_acc, filters_select).ravel())
+
+
+def test_compute_pout_large_votes_do_not_overflow():
+    pout = compute_pout([0, 2000], [2000, 0], [0.9, 0.9], [0.3, 0.3])
+
+    assert np.all(np.isfinite(pout))
+    assert np.allclose(pout, [1., 0.])
+
+
+def test_compute_stopping_rule_matches_loop():
+    rng = np.random.RandomState(2)
+    in_votes, out_votes, filters_acc, filters_select = random_votes(rng, 40, 3, max_votes=5)
+    out_threshold = 0.9
+
+    n_min, joint_prob, classify_score = compute_stopping_rule(in_votes, out_votes, filters_acc, filters_select,
+                                                              out_threshold)
+
+    for item_index in range(in_votes.shape[0]):
+        for filter_index in range(in_votes.shape[1]):
+            n_expected, joint_expected = stopping_rule_loop(
+                in_votes[item_index, filter_index], out_votes[item_index, filter_index],
+                filters_acc[filter_index], filters_select[filter_index], out_threshold)
+            assert n_min[item_index, filter_index] == n_expected
+            assert np.isclose(joint_prob[item_index, filter_index], joint_expected)
+            assert np.isclose(classify_score[item_index, filter_index], joint_expected / n_expected)
+
+
+def test_stopping_rule_table_matches_compute_stopping_rule():
+    rng = np.random.RandomState(3)
+    table = StoppingRuleTable(max_size=50)
+    for out_threshold in (0.9, 0.99, 0.9):
+        in_votes, out_votes, filters_acc, filters_select = random_votes(rng, 60, 3, max_votes=4)
+
+        expected = compute_stopping_rule(in_votes, out_votes, filters_acc, filters_select, out_threshold)
+        # twice, the second lookup is served by the table
+        for _ in range(2):
+            found = table.lookup(in_votes, out_votes, filters_acc, filters_select, out_threshold)
+            assert np.array_equal(found[0], expected[0])
+            assert np.allclose(found[1], expected[1]) and np.allclose(found[2], expected[2])
+        assert len(table) <= 50
+    assert table.hits > 0 and table.misses > 0
+
+
+def test_stopping_rule_table_per_item_params():
+    rng = np.random.RandomState(4)
+    in_votes, out_votes, _, _ = random_votes(rng, 200, 1, max_votes=4)
+    # parameters of the items' own filters, shaped as the votes
+    filters_acc = rng.choice([0.7, 0.8, 0.9], size=in_votes.shape)
+    filters_select = rng.choice([0.2, 0.5], size=in_votes.shape)
+    table = StoppingRuleTable()
+
+    found = table.lookup(in_votes, out_votes, filters_acc, filters_select, 0.95)
+    expected = compute_stopping_rule(in_votes, out_votes, filters_acc, filters_select, 0.95)
+
+    assert np.array_equal(found[0], expected[0])
+    assert np.allclose(found[1], expected[1]) and np.allclose(found[2], expected[2])
+    assert len(table) < in_votes.size
@@ -0,0 +1,41 @@
+import numpy as np
+
+from src.profiling import profile_call
+from src.profiling import summarize
+
+
+def multiply(matrix, times):
+    for _ in range(times):
+        matrix = np.tanh(matrix.dot(matrix))
+    return matrix
+
+
+def test_numpy_builtins_count_as_numpy():
+    matrix = np.random.RandomState(0).uniform(size=(200, 200)) / 200
+    _, profiler = profile_call(multiply, matrix, 50)
+
+    summary = summarize(profiler)
+    categories = summary['categories']
+    assert categories['numpy'] > 0.5 * summary['totalTime']
+    assert categories['numpy'] > categories['other']
+
+
+def test_builtins_count_with_their_caller():
+    # a function of the MSR-Box math spending its time in a built-in of no known module
+    code = compile('import time\ndef wait():\n    time.sleep(0.05)\n', '/package/src/votes.py', 'exec')
+    namespace = {}
+    exec(code, namespace)
+    _, profiler = profile_call(namespace['wait'])
+
+    categories = summarize(profiler)['categories']
+    assert categories['msr'] >= 0.04
+    assert categories['other'] < 0.01
+
+
+def test_sql_builtins_count_as_sql(db):
+    _, profiler = profile_call(db.con.execute, 'select pg_sleep(0.05);')
+
+    summary = summarize(profiler)
+    categories = summary['categories']
+    assert categories['sql'] >= 0.04
+    assert categories['sql'] > 0.5 * summary['totalTime']
@@ -0,0 +1,87 @@
+import threading
+import time
+
+from src.runs import RunQueue
+from src.runs import report_progress
+
+
+class DictStore:
+    '''
+    Stand-in of the runs table of the Database.
+    '''
+
+    def __init__(self):
+        self.runs = {}
+
+    def save_run(self, run_dict):
+        self.runs[run_dict['runId']] = dict(run_dict)
+
+    def get_run(self, run_id):
+        return self.runs.get(run_id)
+
+
+def wait_finished(run_queue, *runs):
+    for run in runs:
+        for _ in range(500):
+            if run_queue.get(run.run_id).finished:
+                break
+            time.sleep(0.01)
+    return [run_queue.get(run.run_id).state for run in runs]
+
+
+def test_queued_run_does_not_hold_a_thread():
+    run_queue = RunQueue(workers=2)
+    release = threading.Event()
+    run_1 = run_queue.submit(1, 'classify', release.wait, 5)
+    run_2 = run_queue.submit(1, 'classify', lambda: 'second')
+    # with run_2 waiting for job 1, the second thread is free for job 2
+    run_3 = run_queue.submit(2, 'classify', lambda: 'other job')
+
+    assert wait_finished(run_queue, run_3) == ['done']
+    assert run_queue.get(run_2.run_id).state == 'queued'
+    release.set()
+    assert wait_finished(run_queue, run_1, run_2) == ['done', 'done']
+    assert run_2.result == 'second'
+
+
+def test_run_waits_for_the_synchronous_calls():
+    run_queue = RunQueue(workers=2)
+    with run_queue.job_lock(1):
+        run = run_queue.submit(1, 'classify', lambda: 'done')
+        time.sleep(0.05)
+        assert run.state == 'queued'
+    assert wait_finished(run_queue, run) == ['done']
+
+    with run_queue.job_lock(1):
+        pass
+    assert not run_queue.busy and not run_queue.pending
+
+
+def test_progress_and_status_in_another_process():
+    store = DictStore()
+    run_queue = RunQueue(workers=1, store=store)
+    release = threading.Event()
+
+    def classify():
+        for chunks_done in range(1, 4):
+            report_progress(chunks_done)
+        release.wait(5)
+        return {'message': 'classified'}
+
+    run = run_queue.submit(1, 'classify', classify)
+    # the queue of another process only knows the run from the store
+    other_queue = RunQueue(workers=1, store=store)
+    for _ in range(500):
+        if (other_queue.get(run.run_id).progress or {}).get('done') == 3:
+            break
+        time.sleep(0.01)
+    run_status = other_queue.get(run.run_id).to_dict()
+    assert run_status['state'] == 'running'
+    assert run_status['progress'] == {'unit': 'chunks', 'done': 3, 'total': None}
+
+    release.set()
+    assert wait_finished(other_queue, run) == ['done']
+    assert other_queue.get(run.run_id).result == {'message': 'classified'}
+    assert other_queue.get('unknown') is None
+    # outside of a run, e.g. in a synchronous request, the progress goes nowhere
+    report_progress(1)
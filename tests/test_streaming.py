@@ -0,0 +1,36 @@
+import numpy as np
+
+from src.baseround.aggregation import expectation_maximization
+from src.baseround.streaming import OnlineTruthInference
+from tests.test_aggregation import simulate_votes
+
+
+def test_online_inference_tracks_em():
+    rng = np.random.RandomState(0)
+    for _ in range(5):
+        Psi, N = simulate_votes(rng, 20, 400, 5)
+        M = len(Psi)
+        A, p = expectation_maximization(N, M, [list(x) for x in Psi])
+
+        # the answers arrive in random order
+        votes = [(s, obj, val) for obj, x in enumerate(Psi) for s, val in x]
+        rng.shuffle(votes)
+        online = OnlineTruthInference()
+        for s, obj, val in votes:
+            online.observe(s, obj, val)
+        acc, p_out = online.estimates()
+
+        A_online = np.array([acc[s] for s in range(N)])
+        assert np.abs(A_online - np.array(A)).mean() < 0.1
+        p_out_online = np.array([p_out[obj] for obj in range(M)])
+        p_out_em = np.array([p[obj][0] for obj in range(M)])
+        assert np.mean((p_out_online > 0.5) == (p_out_em > 0.5)) > 0.9
+
+
+def test_vote_does_not_vouch_for_itself():
+    online = OnlineTruthInference()
+    # a single vote per item says nothing about the accuracy of the worker
+    for obj in range(50):
+        online.observe(1, obj, 0)
+    acc, _ = online.estimates()
+    assert acc[1] == online.prior_accuracy
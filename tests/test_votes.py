@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+from scipy.special import binom
+
+from src.votes import VoteTensor
+from src.msr_box import ClassificationMSR
+
+
+def items_votes_frame(rng, items_num, filter_list, max_in_votes=6, max_out_votes=6):
+    rows = [(item_id, filter_id, rng.randint(0, max_in_votes), rng.randint(0, max_out_votes))
+            for item_id in rng.permutation(np.arange(100, 100 + items_num)) for filter_id in filter_list]
+    return pd.DataFrame(rows, columns=['id', 'criteria_id', 'in_votes', 'out_votes'])
+
+
+def classify_loop(items_votes_data, filter_list, filters_params_dict, out_threshold, in_threshold):
+    # outcomes of ClassificationMSR.classify before the vote tensor, from the DataFrame rows
+    outcomes = {}
+    for item_id in items_votes_data['id'].unique():
+        prob_item_pos = 1.
+        for filter_id in filter_list:
+            filter_acc = filters_params_dict[str(filter_id)]['accuracy']
+            filter_select = filters_params_dict[str(filter_id)]['selectivity']
+            pos_c, neg_c = items_votes_data.loc[(items_votes_data['id'] == item_id) &
+                                                (items_votes_data['criteria_id'] == filter_id)][
+                                                ['in_votes', 'out_votes']].values[0]
+            term_neg = binom(pos_c + neg_c, neg_c) * filter_acc ** (neg_c) \
+                       * (1 - filter_acc) ** pos_c * filter_select
+            term_pos = binom(pos_c + neg_c, pos_c) * filter_acc ** pos_c \
+                       * (1 - filter_acc) ** (neg_c) * (1 - filter_select)
+            prob_item_pos *= term_pos / (term_neg + term_pos)
+        if 1 - prob_item_pos > out_threshold:
+            outcomes[int(item_id)] = 'OUT'
+        elif prob_item_pos > in_threshold:
+            outcomes[int(item_id)] = 'IN'
+    return outcomes
+
+
+def test_from_frame_matches_rows():
+    rng = np.random.RandomState(0)
+    filter_list = [11, 12, 13]
+    items_votes_data = items_votes_frame(rng, 20, filter_list)
+
+    items_votes = VoteTensor.from_frame(items_votes_data, filter_list)
+
+    assert items_votes.item_ids == [int(i) for i in items_votes_data['id'].unique()]
+    assert items_votes.filter_ids == filter_list
+    for item_id, filter_id, in_votes, out_votes in items_votes_data.itertuples(index=False):
+        item_index, filter_index = items_votes.item_map[item_id], items_votes.filter_map[filter_id]
+        assert items_votes.in_votes[item_index, filter_index] == in_votes
+        assert items_votes.out_votes[item_index, filter_index] == out_votes
+
+
+def test_from_frame_drops_unknown_filters_and_fills_missing_pairs():
+    items_votes_data = pd.DataFrame([(1, 11, 2, 3), (1, 99, 5, 5), (2, 12, 1, 0)],
+                                    columns=['id', 'criteria_id', 'in_votes', 'out_votes'])
+
+    items_votes = VoteTensor.from_frame(items_votes_data, [11, 12])
+
+    assert items_votes.item_ids == [1, 2]
+    assert items_votes.votes.tolist() == [[[2, 3], [0, 0]], [[0, 0], [1, 0]]]
+
+
+def test_from_frame_empty():
+    items_votes_data = pd.DataFrame([], columns=['id', 'criteria_id', 'in_votes', 'out_votes'])
+
+    items_votes = VoteTensor.from_frame(items_votes_data, [11, 12])
+
+    assert len(items_votes) == 0
+    assert items_votes.votes.shape == (0, 2, 2)
+
+
+def test_classify_items_matches_loop():
+    rng = np.random.RandomState(1)
+    filter_list = [11, 12, 13]
+    filters_params_dict = {'11': {'accuracy': .8, 'selectivity': .3},
+                           '12': {'accuracy': .9, 'selectivity': .2},
+                           '13': {'accuracy': .7, 'selectivity': .5}}
+    items_votes_data = items_votes_frame(rng, 60, filter_list, max_in_votes=10, max_out_votes=3)
+    classification = ClassificationMSR.__new__(ClassificationMSR)
+    classification.filters_params_dict = filters_params_dict
+    classification.out_threshold = .9
+    classification.in_threshold = .85
+
+    items_classified = classification._classify_items(VoteTensor.from_frame(items_votes_data, filter_list))
+
+    assert {item_id: item_data['outcome'] for item_id, item_data in items_classified.items()} == \
+        classify_loop(items_votes_data, filter_list, filters_params_dict, .9, .85)
@@ -0,0 +1,23 @@
+from src.watermark import TaskWatermark
+
+
+def test_after_keeps_the_unanswered_tasks():
+    watermark = TaskWatermark().after([1, 2, 3, 4], [True, False, True, False])
+    assert watermark.task_id == 4 and watermark.pending_task_ids == {2, 4}
+    assert watermark.sql_filter() == '(t.id > 4 or t.id in (2, 4))'
+
+    # the tasks read again, 2 is answered now
+    watermark = watermark.after([2, 4, 5], [True, False, True])
+    assert watermark.task_id == 5 and watermark.pending_task_ids == {4}
+    assert watermark.sql_filter('id') == '(id > 5 or id in (4))'
+
+
+def test_after_gives_up_old_pending_tasks():
+    watermark = TaskWatermark().after([1, 2, 3], [False, False, True])
+    # the tasks pending for max_pending_span tasks are given up
+    task_id = 1 + TaskWatermark.max_pending_span
+    watermark = watermark.after([1, 2, task_id], [False, False, True])
+    assert watermark.task_id == task_id and watermark.pending_task_ids == {2}
+    watermark = watermark.after([2, task_id + 1], [False, False])
+    assert watermark.pending_task_ids == {task_id + 1}
+    assert TaskWatermark().after([], []).sql_filter() == 't.id > 0'